@@ -1,40 +1,182 @@
-import os
+#!/usr/bin/env python3
+"""
+七牛云ASR批量识别工具：并发识别大量音频URL或本地文件，用于质检和历史录音的文字回填。
+
+Usage examples:
+  - python asr.py https://example.com/a.mp3 https://example.com/b.mp3
+  - python asr.py --list inputs.txt --output results.ndjson --concurrency 8 --retries 2
+  - python asr.py recordings/*.wav --serve 0.0.0.0:8090 --public-url http://my-host:8090
+
+输入：
+  - http(s) URL 直接交给ASR
+  - 本地文件先写入blob存储，以签名URL提供给ASR（七牛云只接受URL）：默认由 BLOB_PUBLIC_BASE_URL
+    指向的后端服务提供下载（需与后端共用 BLOB_DIR 和 BLOB_SECRET）；或用 --serve 在本进程内临时提供，
+    --public-url 为七牛云可访问到该端口的地址
+  - 音频格式取扩展名（默认mp3），也可用 --format 指定
+  - 不传任何输入时识别 ASR_AUDIO_URL（默认为官方示例音频）
+
+输出：每条识别完成（成功或最终失败）立即追加一行 {"input", "text", "latency", "error"} 到NDJSON文件，
+最后打印吞吐、耗时分位数和失败明细。本地文件与后端共用 VoiceService 的静音裁剪、识别结果缓存和
+自适应并发调度。缺少 QINIU_TTS_KEY 时为测试模式，返回模拟识别结果。
+"""
+
+import argparse
+import asyncio
 import json
-import requests
-
-BASE = os.getenv("QINIU_BASE_URL", "https://openai.qiniu.com/v1")
-API_KEY = os.getenv("QINIU_TTS_KEY", "")  # 建议用环境变量
-AUDIO_URL = os.getenv(
-    "ASR_AUDIO_URL",
-    "https://static.qiniu.com/ai-inference/example-resources/example.mp3"  # 官方示例URL
-)
-
-headers = {
-    "Content-Type": "application/json",
-    "Authorization": f"Bearer {API_KEY}",   # 文档要求 Bearer 前缀
-}
-
-payload = {
-    "model": "asr",
-    "audio": {
-        "format": "mp3",
-        "url": AUDIO_URL            # 必须是 http(s) 公网可访问
-    }
-}
-
-# 测试模式：如果没有API密钥，使用模拟数据
-if not API_KEY:
-    print("测试模式：ASR配置缺失，使用模拟识别结果")
-    print("HTTP 200")
-    print("Body (preview): {\"data\":{\"result\":{\"text\":\"这是测试模式的语音识别结果\"}}}")
-    print("\n识别文本：这是测试模式的语音识别结果")
-    exit(0)
-resp = requests.post(f"{BASE}/voice/asr", headers=headers, json=payload, timeout=60)
-print("HTTP", resp.status_code)
-print("Body (preview):", resp.text[:500])
-
-resp.raise_for_status()
-data = resp.json()
-# 返回结构：data.result.text
-text = (data.get("data", {}).get("result", {}) or {}).get("text")
-print("\n识别文本：", text or "<未返回文本>")
+import os
+import sys
+import time
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlparse
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend")
+sys.path.insert(0, BACKEND_DIR)
+# 与后端服务使用同一个blob目录（后端以backend为工作目录运行）
+os.environ.setdefault("BLOB_DIR", os.path.join(BACKEND_DIR, "blob_store"))
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import FileResponse, Response
+from starlette.routing import Route
+
+from batch_runner import BatchStats, run_batch
+from blob_store import BlobStore
+from http_client import close_http_client
+from voice_service import VoiceService
+
+DEFAULT_AUDIO_URL = "https://static.qiniu.com/ai-inference/example-resources/example.mp3"  # 官方示例URL
+MOCK_TEXT = "这是测试模式的语音识别结果"
+
+
+def read_inputs(args: argparse.Namespace) -> List[str]:
+    """合并命令行和列表文件中的输入，列表文件中的空行和#注释会被忽略"""
+    inputs = list(args.inputs)
+    if args.list:
+        with open(args.list, "r", encoding="utf-8") as f:
+            inputs.extend(line.strip() for line in f if line.strip() and not line.startswith("#"))
+    return inputs or [os.getenv("ASR_AUDIO_URL", DEFAULT_AUDIO_URL)]
+
+
+def is_url(source: str) -> bool:
+    return urlparse(source).scheme in ("http", "https")
+
+
+def audio_format_of(source: str, default: Optional[str]) -> str:
+    if default:
+        return default
+    extension = os.path.splitext(urlparse(source).path if is_url(source) else source)[1].lstrip(".").lower()
+    return extension or "mp3"
+
+
+def blob_app(blob_store: BlobStore) -> Starlette:
+    """仅提供签名blob下载的最小应用，供 --serve 使用"""
+
+    async def get_blob(request: Request) -> Response:
+        blob_id = request.path_params["blob_id"]
+        try:
+            path = blob_store.path(blob_id)
+            expires = int(request.query_params["expires"])
+            sig = request.query_params["sig"]
+        except (KeyError, ValueError):
+            return Response(status_code=404)
+        if not blob_store.verify(blob_id, expires, sig):
+            return Response(status_code=403)
+        if not os.path.exists(path):
+            return Response(status_code=404)
+        return FileResponse(path, media_type=blob_store.content_type(blob_id))
+
+    return Starlette(routes=[Route("/blobs/{blob_id}", get_blob)])
+
+
+async def recognize_all(args: argparse.Namespace) -> BatchStats:
+    inputs = read_inputs(args)
+    server = None
+    if args.serve:
+        host, _, port = args.serve.rpartition(":")
+        public_url = args.public_url or f"http://{host or '127.0.0.1'}:{port}"
+        blob_store = BlobStore(public_base_url=public_url)
+        server = uvicorn.Server(uvicorn.Config(blob_app(blob_store), host=host or "127.0.0.1", port=int(port),
+                                               log_level="warning"))
+        serve_task = asyncio.create_task(server.serve())
+        while not server.started:
+            if serve_task.done():
+                await serve_task
+                raise RuntimeError(f"无法在 {args.serve} 上提供本地文件下载")
+            await asyncio.sleep(0.05)
+        print(f"本地文件通过 {public_url}/blobs/ 提供给七牛云ASR")
+    else:
+        blob_store = BlobStore()
+
+    voice_service = VoiceService(blob_store=blob_store)
+    if not voice_service.api_key:
+        print("测试模式：ASR配置缺失，使用模拟识别结果")
+
+    stats = BatchStats()
+    failures: List[Dict[str, Any]] = []
+
+    async def recognize(source: str) -> Dict[str, Any]:
+        audio_format = audio_format_of(source, args.format)
+        start = time.monotonic()
+        if is_url(source):
+            text = await voice_service.recognize_url(source, audio_format) if voice_service.api_key else MOCK_TEXT
+        else:
+            with open(source, "rb") as f:
+                text = await voice_service.speech_to_text(f, audio_format, fallback=False)
+        return {"text": text, "latency": round(time.monotonic() - start, 3)}
+
+    with open(args.output, "w", encoding="utf-8") as output:
+        def on_result(source: str, result: Optional[Dict[str, Any]], error: Optional[BaseException]):
+            record = {"input": source, "text": None, "latency": None, "error": None}
+            if error is not None:
+                record["error"] = str(error) or type(error).__name__
+                failures.append(record)
+            else:
+                record.update(result)
+            output.write(json.dumps(record, ensure_ascii=False) + "\n")
+            output.flush()
+
+        try:
+            await run_batch(inputs, recognize, concurrency=args.concurrency, retries=args.retries,
+                            on_result=on_result, stats=stats)
+        finally:
+            if server is not None:
+                server.should_exit = True
+                await serve_task
+            await close_http_client()
+
+    summary = stats.summary()
+    print("\n识别统计：")
+    print(f"  成功 {summary['ok']} 条，失败 {summary['failed']} 条（{summary['error_rate'] * 100:.1f}%），重试 {summary['retries']} 次")
+    print(f"  耗时 {summary['elapsed']} 秒，吞吐 {summary['throughput']} 条/秒")
+    print(f"  单条耗时 p50 {summary['latency_p50']}s / p95 {summary['latency_p95']}s / "
+          f"p99 {summary['latency_p99']}s / 最大 {summary['latency_max']}s")
+    for record in failures[:10]:
+        print(f"  失败 {record['input']}: {record['error']}")
+    if len(failures) > 10:
+        print(f"  ……其余 {len(failures) - 10} 条失败见 {args.output}")
+    print(f"结果已写入 {args.output}")
+    return stats
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Batch speech recognition with Qiniu ASR")
+    parser.add_argument("inputs", nargs="*", help="Audio URLs or local files")
+    parser.add_argument("--list", help="File with one audio URL or path per line")
+    parser.add_argument("--output", default="asr_results.ndjson", help="NDJSON file written as results complete")
+    parser.add_argument("--format", default=None, help="Audio format for all inputs (default: by extension, else mp3)")
+    parser.add_argument("--concurrency", type=int, default=int(os.getenv("ASR_BATCH_CONCURRENCY", "4")), help="Maximum concurrent recognitions")
+    parser.add_argument("--retries", type=int, default=2, help="Retries per input with exponential backoff")
+    parser.add_argument("--serve", default=None, help="HOST:PORT to serve local files from this process")
+    parser.add_argument("--public-url", default=None, help="Base URL at which Qiniu can reach --serve (default: http://HOST:PORT)")
+    return parser
+
+
+def main() -> None:
+    args = build_parser().parse_args()
+    stats = asyncio.run(recognize_all(args))
+    sys.exit(1 if stats.failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,62 +1,136 @@
-import requests
 import json
 import asyncio
-from typing import Dict, Any, List
+import time
+from collections import deque
+from contextlib import aclosing
+from typing import Dict, Any, List, Optional, AsyncIterator
 import os
 
+import httpx
+
+from http_client import get_http_client
+from single_flight import SingleFlight, request_key
+from prompt_templates import PromptRegistry
+from upstream_scheduler import UpstreamScheduler, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND, percentile
+from model_router import ModelRouter
+from resilience import CircuitBreaker, Deadline, DeadlineExceeded, is_retryable, is_upstream_failure, backoff_delay
+from usage_tracker import UsageTracker, set_usage_account
+
+FALLBACK_REPLY = "抱歉，我现在无法回应，请稍后再试。"
+
 class AIService:
-    def __init__(self):
+    def __init__(self, http_client: Optional[httpx.AsyncClient] = None,
+                 usage_tracker: Optional[UsageTracker] = None):
         # 从环境变量读取，避免把密钥写入仓库
         self.api_key = os.getenv("ALIBABA_CLOUD_API_KEY", "")
-        self.base_url = "https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation"
+        # 可通过DASHSCOPE_BASE_URL指向本地替身服务（upstream_stub.py）做压测
+        self.base_url = os.getenv(
+            "DASHSCOPE_BASE_URL",
+            "https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation"
+        )
         self.model = "qwen-max"
+        self.timeout = 30
+        # 未显式传入时使用进程内共享的连接池
+        self._http_client = http_client
+        self.single_flight = SingleFlight()
+        # 角色提示词注册表，由CharacterManager在加载角色数据时编译
+        self.prompts = PromptRegistry()
+        # 上游并发调度：自适应并发上限，交互对话优先于后台任务
+        self.scheduler = UpstreamScheduler.from_env("dashscope", "DASHSCOPE")
+        # 熔断与时间预算：上游故障时快速失败，单次请求（含排队和重试）不超过预算
+        self.breaker = CircuitBreaker(
+            "dashscope",
+            failure_threshold=int(os.getenv("DASHSCOPE_BREAKER_THRESHOLD", "5")),
+            recovery_timeout=float(os.getenv("DASHSCOPE_BREAKER_RESET", "30"))
+        )
+        self.request_budget = float(os.getenv("DASHSCOPE_REQUEST_BUDGET", "30"))
+        self.max_retries = int(os.getenv("DASHSCOPE_MAX_RETRIES", "2"))
+        # 对冲请求默认关闭，开启后会增加上游调用量
+        self.hedge_enabled = os.getenv("DASHSCOPE_HEDGE", "").lower() in ("1", "true", "yes")
+        self._latencies = deque(maxlen=200)
+        self.retries = 0
+        self.hedges = 0
+        # 按任务与实时延迟/错误率在多个模型间路由，self.model为默认模型
+        self.router = ModelRouter.from_env(self.model)
+        # 按用户/角色统计token用量，未传入时不统计
+        self.usage_tracker = usage_tracker
+
+    @property
+    def http_client(self) -> httpx.AsyncClient:
+        """上游请求使用的异步HTTP客户端"""
+        return self._http_client or get_http_client()
+        
+    async def chat_with_character(self, character: Dict[str, Any], user_message: str,
+                                  context: Optional[Dict[str, Any]] = None) -> str:
+        """与AI角色进行对话（context为ConversationContext构建的多轮上下文）"""
+        set_usage_account(character_id=character["id"])
+        messages = self._build_chat_messages(character, user_message, context)
+        
+        # 调用阿里云百炼API
+        response = await self._call_qwen_api(messages)
+        return response
+    
+    async def stream_chat_with_character(self, character: Dict[str, Any], user_message: str,
+                                         context: Optional[Dict[str, Any]] = None) -> AsyncIterator[str]:
+        """与AI角色进行流式对话，逐段产出增量文本"""
+        set_usage_account(character_id=character["id"])
+        messages = self._build_chat_messages(character, user_message, context)
         
-    async def chat_with_character(self, character: Dict[str, Any], user_message: str) -> str:
-        """与AI角色进行对话"""
+        async with aclosing(self._stream_qwen_api(messages)) as deltas:
+            async for delta in deltas:
+                yield delta
+    
+    def _build_chat_messages(self, character: Dict[str, Any], user_message: str,
+                             context: Optional[Dict[str, Any]] = None) -> List[Dict[str, str]]:
+        """构建对话消息"""
         # 构建角色提示词
         system_prompt = self._build_character_prompt(character)
+        history = []
         
-        # 构建消息
-        messages = [
+        if context:
+            # 摘要追加在角色提示词之后，保持提示词前缀不变
+            if context.get("summary"):
+                system_prompt += f"\n\n此前对话摘要：{context['summary']}"
+            history = context.get("history", [])
+        
+        return [
             {"role": "system", "content": system_prompt},
+            *history,
             {"role": "user", "content": user_message}
         ]
+    
+    async def summarize_conversation(self, character: Dict[str, Any], previous_summary: str,
+                                     turns: List[Dict[str, Any]], max_tokens: int = 500) -> str:
+        """把新的对话轮次增量合并进已有摘要，失败时返回空字符串"""
+        set_usage_account(character_id=character["id"])
+        speakers = {"user": "用户", "assistant": character["name"]}
+        transcript = "\n".join(
+            f"{speakers.get(turn['role'], turn['role'])}：{turn['content']}" for turn in turns
+        )
         
-        # 调用阿里云百炼API
-        response = await self._call_qwen_api(messages)
-        return response
+        messages = [
+            {"role": "system", "content": "你负责为角色扮演对话维护一份简洁的滚动摘要，保留用户的身份、偏好、关键事实和尚未结束的话题，不要编造内容。"},
+            {"role": "user", "content": f"已有摘要：{previous_summary or '（无）'}\n\n新增对话：\n{transcript}\n\n请输出合并后的新摘要，不超过{max_tokens}字。"}
+        ]
+        
+        summary = await self._call_qwen_api(messages, PRIORITY_BACKGROUND, "summary", max_tokens)
+        if summary == FALLBACK_REPLY:
+            return ""
+        return summary[:max_tokens]
     
     def _build_character_prompt(self, character: Dict[str, Any]) -> str:
-        """构建角色提示词"""
-        prompt = f"""你是{character['name']}，{character['description']}
-
-角色设定：
-- 性格特点：{character['personality']}
-- 说话风格：{character['speaking_style']}
-- 知识背景：{character['knowledge']}
-- 特殊技能：{', '.join(character['skills'])}
-
-请严格按照角色设定进行对话，保持角色的独特性和一致性。你的回答应该：
-1. 符合角色的性格和说话风格
-2. 体现角色的知识背景
-3. 保持对话的自然流畅
-4. 适当使用角色的特殊技能
-5. 语言生动有趣，富有感染力
-6. 适当使用角色相关的专业术语或表达方式
-
-记住，你就是{character['name']}本人，请以第一人称进行对话。让对话充满活力和个性！"""
-        
-        return prompt
+        """构建角色提示词（取自预编译的提示词注册表）"""
+        return self.prompts.get(character, "chat").text
     
-    async def _call_qwen_api(self, messages: List[Dict[str, str]]) -> str:
-        """调用通义千问API"""
+    def _build_request(self, messages: List[Dict[str, str]], stream: bool = False, model: Optional[str] = None):
+        """构建通义千问API请求头和请求体"""
         headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
         }
         
         data = {
-            "model": self.model,
+            "model": model or self.model,
             "input": {
                 "messages": messages
             },
@@ -67,87 +141,254 @@ class AIService:
             }
         }
         
-        try:
-            response = requests.post(
-                self.base_url,
-                headers=headers,
-                json=data,
-                timeout=30
-            )
-            response.raise_for_status()
+        if stream:
+            # 开启SSE，并让每个事件只携带新增的文本
+            headers["Accept"] = "text/event-stream"
+            headers["X-DashScope-SSE"] = "enable"
+            data["parameters"]["incremental_output"] = True
+        
+        return headers, data
+    
+    async def _call_qwen_api(self, messages: List[Dict[str, str]], priority: int = PRIORITY_INTERACTIVE,
+                             task: str = "chat", expected_output: Optional[int] = None) -> str:
+        """调用通义千问API（按任务路由模型，相同的并发请求合并为一次上游调用）"""
+        models = self.router.route(task, len(messages[-1]["content"]), expected_output)
+        headers, data = self._build_request(messages, model=models[0])
+        return await self.single_flight.do(
+            request_key(data),
+            lambda: self._post_qwen_api(headers, data, priority, models)
+        )
+    
+    async def _post_qwen_api(self, headers: Dict[str, str], data: Dict[str, Any], priority: int,
+                             models: List[str]) -> str:
+        """向通义千问API发送请求：熔断快速失败，在截止时间预算内有限重试，重试时换用备选模型"""
+        deadline = Deadline(self.request_budget)
+        
+        for attempt in range(self.max_retries + 1):
+            if not self.breaker.allow():
+                print("通义千问API熔断中，直接返回降级回复")
+                return FALLBACK_REPLY
+            # 半开状态下本次请求是探测请求：无论以何种方式结束都要结束探测，否则熔断器会一直拒绝请求
+            probe = self.breaker.state == CircuitBreaker.HALF_OPEN
             
-            result = response.json()
-            if "output" in result and "text" in result["output"]:
-                return result["output"]["text"]
-            else:
-                return "抱歉，我现在无法回应，请稍后再试。"
+            try:
+                body = {**data, "model": models[min(attempt, len(models) - 1)]}
+                result = await self._hedged_attempt(headers, body, priority, deadline)
+                self.breaker.record_success()
+                
+                if "output" in result and "text" in result["output"]:
+                    return result["output"]["text"]
+                else:
+                    return FALLBACK_REPLY
+                    
+            except Exception as e:
+                print(f"API调用错误: {e}")
+                if not is_retryable(e):
+                    return FALLBACK_REPLY
+                if is_upstream_failure(e):
+                    self.breaker.record_failure()
                 
-        except Exception as e:
-            print(f"API调用错误: {e}")
-            return "抱歉，我现在无法回应，请稍后再试。"
+                delay = backoff_delay(attempt)
+                if attempt == self.max_retries or deadline.remaining() <= delay:
+                    return FALLBACK_REPLY
+                self.retries += 1
+                await asyncio.sleep(delay)
+            finally:
+                if probe:
+                    self.breaker.end_probe()
+        
+        return FALLBACK_REPLY
     
-    async def generate_story(self, character: Dict[str, Any], topic: str) -> str:
-        """生成角色相关的故事"""
-        system_prompt = f"""你是{character['name']}，现在需要根据主题"{topic}"创作一个故事。
-
-请以你的角色身份和视角来创作这个故事，体现你的：
-- 性格特点：{character['personality']}
-- 知识背景：{character['knowledge']}
-- 创作风格：{character.get('writing_style', '生动有趣')}
-
-故事要求：
-1. 长度适中（200-500字）
-2. 情节完整，有起承转合
-3. 体现角色的独特视角
-4. 语言生动，富有感染力"""
+    async def _attempt_qwen_api(self, headers: Dict[str, str], data: Dict[str, Any], priority: int,
+                                deadline: Deadline) -> Dict[str, Any]:
+        """一次请求尝试，排队和请求时间都计入截止时间预算；
+        拿到并发名额之前预算就用完时抛出DeadlineExceeded，不计为上游故障"""
+        if deadline.expired:
+            raise DeadlineExceeded("请求时间预算已用完")
+        acquired = False
         
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": f"请创作一个关于{topic}的故事"}
-        ]
+        async def send():
+            nonlocal acquired
+            try:
+                async with self.scheduler.slot(priority, deadline.expires_at) as slot:
+                    acquired = True
+                    response = await self.http_client.post(
+                        self.base_url,
+                        headers=headers,
+                        json=data,
+                        timeout=min(self.timeout, deadline.remaining())
+                    )
+                    slot.record_status(response.status_code)
+                    response.raise_for_status()
+            except Exception as e:
+                if is_upstream_failure(e):
+                    self.router.record(data["model"], None, False)
+                raise
+            self._latencies.append(slot.latency)
+            self.router.record(data["model"], slot.latency, True)
+            result = response.json()
+            self._record_usage(data["model"], result.get("usage"), slot.latency)
+            return result
         
-        return await self._call_qwen_api(messages)
+        try:
+            return await asyncio.wait_for(send(), deadline.remaining())
+        except asyncio.TimeoutError:
+            # 还在排队时超时与上游无关；HTTP请求进行中超时才计为上游故障
+            if not acquired:
+                raise DeadlineExceeded("排队等待并发名额时用完了请求时间预算")
+            raise
     
-    async def give_advice(self, character: Dict[str, Any], problem: str) -> str:
-        """基于角色背景给出建议"""
-        system_prompt = f"""你是{character['name']}，现在有人向你寻求建议。
-
-请基于你的：
-- 人生经历：{character['knowledge']}
-- 智慧观点：{character['personality']}
-- 专业领域：{character.get('expertise', '人生智慧')}
-
-给出真诚、有深度的建议。你的建议应该：
-1. 体现你的独特视角和智慧
-2. 实用且具有启发性
-3. 语言温暖，富有同理心
-4. 结合你的经历给出具体指导"""
+    async def _hedged_attempt(self, headers: Dict[str, str], data: Dict[str, Any], priority: int,
+                              deadline: Deadline) -> Dict[str, Any]:
+        """超过p95延迟仍未返回时发出第二个请求，取先成功的结果"""
+        hedge_after = self._hedge_delay()
+        if hedge_after is None:
+            return await self._attempt_qwen_api(headers, data, priority, deadline)
         
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": f"我遇到了这样的问题：{problem}，请给我一些建议"}
-        ]
+        first = asyncio.ensure_future(self._attempt_qwen_api(headers, data, priority, deadline))
+        done, _ = await asyncio.wait({first}, timeout=hedge_after)
+        if done or self.breaker.state != CircuitBreaker.CLOSED:
+            return await first
         
-        return await self._call_qwen_api(messages)
+        self.hedges += 1
+        second = asyncio.ensure_future(self._attempt_qwen_api(headers, data, priority, deadline))
+        pending = {first, second}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
     
-    async def answer_question(self, character: Dict[str, Any], question: str) -> str:
-        """回答基于角色知识的问题"""
-        system_prompt = f"""你是{character['name']}，现在有人向你提问。
-
-请基于你的专业知识：
-- 知识领域：{character['knowledge']}
-- 专业背景：{character.get('expertise', '')}
-- 独特见解：{character['personality']}
-
-给出准确、深入的答案。你的回答应该：
-1. 体现你的专业水平
-2. 语言清晰易懂
-3. 包含具体的例子或解释
-4. 保持角色的说话风格"""
+    def _hedge_delay(self) -> Optional[float]:
+        """对冲请求的触发时间（近期p95延迟），未开启或样本不足时返回None"""
+        if not self.hedge_enabled or len(self._latencies) < 20:
+            return None
+        return percentile(self._latencies, 0.95)
+    
+    async def _stream_qwen_api(self, messages: List[Dict[str, str]],
+                               priority: int = PRIORITY_INTERACTIVE, task: str = "chat") -> AsyncIterator[str]:
+        """以流式方式调用通义千问API，逐段产出增量文本（相同的并发请求共享同一条流）"""
+        models = self.router.route(task, len(messages[-1]["content"]))
+        headers, data = self._build_request(messages, stream=True, model=models[0])
+        # 调用方提前关闭时立即退订（由aclosing逐层关闭），而不是等垃圾回收
+        async with aclosing(self.single_flight.stream(
+            request_key(data),
+            lambda: self._post_qwen_stream(headers, data, priority, models)
+        )) as deltas:
+            async for delta in deltas:
+                yield delta
+    
+    async def _post_qwen_stream(self, headers: Dict[str, str], data: Dict[str, Any],
+                                priority: int, models: List[str]) -> AsyncIterator[str]:
+        """向通义千问API发送流式请求（整个流持续期间占用一个并发名额），首个增量之前失败可重试"""
+        deadline = Deadline(self.request_budget)
+        received = False
         
+        for attempt in range(self.max_retries + 1):
+            if not self.breaker.allow():
+                print("通义千问API熔断中，直接返回降级回复")
+                break
+            probe = self.breaker.state == CircuitBreaker.HALF_OPEN
+            
+            model = models[min(attempt, len(models) - 1)]
+            usage = None
+            started = time.monotonic()
+            try:
+                if deadline.expired:
+                    raise DeadlineExceeded("请求时间预算已用完")
+                async with self.scheduler.slot(priority, deadline.expires_at) as slot:
+                    async with self.http_client.stream(
+                        "POST",
+                        self.base_url,
+                        headers=headers,
+                        json={**data, "model": model},
+                        timeout=min(self.timeout, deadline.remaining())
+                    ) as response:
+                        slot.record_status(response.status_code)
+                        response.raise_for_status()
+                        
+                        async for line in response.aiter_lines():
+                            # SSE事件中只关心 data: 行
+                            if not line.startswith("data:"):
+                                continue
+                            event = json.loads(line[5:].strip())
+                            # usage为累计值，以最后一个事件为准
+                            usage = event.get("usage") or usage
+                            delta = event.get("output", {}).get("text")
+                            if delta:
+                                received = True
+                                yield delta
+                self.breaker.record_success()
+                self.router.record(model, slot.latency, True)
+                self._record_usage(model, usage, time.monotonic() - started)
+                break
+                
+            except Exception as e:
+                print(f"流式API调用错误: {e}")
+                if usage:
+                    # 中途断开的流同样已经消耗了token
+                    self._record_usage(model, usage, time.monotonic() - started)
+                if not is_retryable(e):
+                    break
+                if is_upstream_failure(e):
+                    self.breaker.record_failure()
+                    self.router.record(model, None, False)
+                
+                # 已经推送过内容就不能再重试，否则客户端会收到重复文本
+                delay = backoff_delay(attempt)
+                if received or attempt == self.max_retries or deadline.remaining() <= delay:
+                    break
+                self.retries += 1
+                await asyncio.sleep(delay)
+            finally:
+                # 客户端断开（生成器被关闭或取消）时同样要结束探测
+                if probe:
+                    self.breaker.end_probe()
+        
+        if not received:
+            yield FALLBACK_REPLY
+    
+    def _record_usage(self, model: str, usage: Optional[Dict[str, Any]], latency: Optional[float]):
+        """上报一次上游调用的token用量（归属为当前请求的用户和角色）"""
+        if self.usage_tracker:
+            self.usage_tracker.record(model, usage, latency)
+    
+    def resilience_stats(self) -> Dict[str, Any]:
+        """熔断、重试与对冲请求统计"""
+        return {
+            "breaker": self.breaker.stats(),
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "latency_p50": round(percentile(self._latencies, 0.5), 4),
+            "latency_p95": round(percentile(self._latencies, 0.95), 4)
+        }
+    
+    async def run_template(self, character: Dict[str, Any], template: str, user_message: str,
+                           priority: int = PRIORITY_INTERACTIVE, task: Optional[str] = None) -> str:
+        """使用预编译的系统提示词模板完成一次对话（task用于模型路由，默认为模板名）"""
+        set_usage_account(character_id=character["id"])
         messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": question}
+            {"role": "system", "content": self.prompts.get(character, template).text},
+            {"role": "user", "content": user_message}
         ]
         
-        return await self._call_qwen_api(messages)
+        return await self._call_qwen_api(messages, priority, task or template)
+    
+    async def generate_story(self, character: Dict[str, Any], topic: str) -> str:
+        """生成角色相关的故事"""
+        return await self.run_template(character, "story", f"请创作一个关于{topic}的故事")
+    
+    async def give_advice(self, character: Dict[str, Any], problem: str) -> str:
+        """基于角色背景给出建议"""
+        return await self.run_template(character, "advice", f"我遇到了这样的问题：{problem}，请给我一些建议")
+    
+    async def answer_question(self, character: Dict[str, Any], question: str) -> str:
+        """回答基于角色知识的问题"""
+        return await self.run_template(character, "answer", question)
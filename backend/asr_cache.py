@@ -0,0 +1,85 @@
+import hashlib
+from collections import OrderedDict
+from typing import Any, BinaryIO, Dict, Optional, Union
+
+
+class AsrCache:
+    """语音识别结果缓存：按音频内容摘要和模型寻址，内存中LRU淘汰，可选持久化到SQLite"""
+
+    def __init__(self, max_entries: int = 2048, db_manager=None):
+        self.max_entries = max_entries
+        # 传入数据库时，内存未命中会再查一次持久化的结果（重启后仍然有效）
+        self.db_manager = db_manager
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.persist_errors = 0
+
+    @staticmethod
+    def make_key(audio: Union[bytes, memoryview, BinaryIO], model: str) -> str:
+        """计算缓存键：模型名 + 音频内容的sha256；文件对象分块读取后回到开头"""
+        digest = hashlib.sha256(model.encode("utf-8") + b"\0")
+        if isinstance(audio, (bytes, bytearray, memoryview)):
+            digest.update(audio)
+        else:
+            for chunk in iter(lambda: audio.read(64 * 1024), b""):
+                digest.update(chunk)
+            audio.seek(0)
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """读取识别结果，未命中时返回None"""
+        text = self._entries.get(key)
+        if text is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return text
+
+        if self.db_manager is not None:
+            try:
+                text = self.db_manager.get_asr_result(key)
+            except Exception as e:
+                print(f"读取识别结果缓存失败: {e}")
+                self.persist_errors += 1
+            if text is not None:
+                self._remember(key, text)
+                self.persistent_hits += 1
+                return text
+
+        self.misses += 1
+        return None
+
+    def set(self, key: str, model: str, text: str):
+        """写入识别结果"""
+        self._remember(key, text)
+        if self.db_manager is not None:
+            try:
+                self.db_manager.save_asr_result(key, model, text)
+            except Exception as e:
+                print(f"保存识别结果缓存失败: {e}")
+                self.persist_errors += 1
+
+    def _remember(self, key: str, text: str):
+        self._entries[key] = text
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """识别结果缓存统计"""
+        hits = self.hits + self.persistent_hits
+        lookups = hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "persistent": self.db_manager is not None,
+            "hits": self.hits,
+            "persistent_hits": self.persistent_hits,
+            "misses": self.misses,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "persist_errors": self.persist_errors
+        }
@@ -0,0 +1,98 @@
+import struct
+from typing import Any, Dict, NamedTuple, Optional, Tuple, Union
+
+# WebSocket二进制音频帧：12字节头 + 原始音频
+# 头部（网络字节序）：版本(1) 类型(1) 编码(1) 标志(1) 消息ID(4) 序号(4)
+FRAME_HEADER = struct.Struct("!BBBBII")
+FRAME_VERSION = 1
+
+# 帧类型
+FRAME_VOICE_INPUT = 1    # 客户端上传的语音消息
+FRAME_REPLY_AUDIO = 2    # 服务端回复的语音（流式回复时每句一帧）
+
+# 标志位
+FLAG_LAST = 0x01         # 该消息的最后一帧
+FLAG_STREAM = 0x02       # 客户端请求流式回复
+
+CODECS = {1: "mp3", 2: "wav", 3: "webm", 4: "pcm", 5: "ogg"}
+CODEC_IDS = {name: codec_id for codec_id, name in CODECS.items()}
+
+
+class FrameError(ValueError):
+    """二进制帧格式错误"""
+
+
+class FrameHeader(NamedTuple):
+    frame_type: int
+    codec: str
+    flags: int
+    message_id: int
+    sequence: int
+
+    @property
+    def last(self) -> bool:
+        return bool(self.flags & FLAG_LAST)
+
+    @property
+    def stream(self) -> bool:
+        return bool(self.flags & FLAG_STREAM)
+
+
+def encode_frame(frame_type: int, message_id: int, sequence: int, audio: bytes,
+                 codec: str = "mp3", flags: int = FLAG_LAST) -> bytes:
+    """编码一个二进制音频帧"""
+    header = FRAME_HEADER.pack(FRAME_VERSION, frame_type, CODEC_IDS[codec], flags, message_id, sequence)
+    return header + audio
+
+
+def decode_frame(data: Union[bytes, bytearray, memoryview]) -> Tuple[FrameHeader, memoryview]:
+    """解析二进制音频帧，音频部分以memoryview返回，不复制数据"""
+    view = memoryview(data)
+    if len(view) < FRAME_HEADER.size:
+        raise FrameError("帧长度不足")
+    version, frame_type, codec_id, flags, message_id, sequence = FRAME_HEADER.unpack_from(view)
+    if version != FRAME_VERSION:
+        raise FrameError(f"不支持的帧版本: {version}")
+    if codec_id not in CODECS:
+        raise FrameError(f"未知的音频编码: {codec_id}")
+    return FrameHeader(frame_type, CODECS[codec_id], flags, message_id, sequence), view[FRAME_HEADER.size:]
+
+
+class FrameAssembler:
+    """按消息ID拼接分多帧上传的语音消息：序号从0开始连续递增，带FLAG_LAST的帧结束一条消息"""
+
+    def __init__(self, max_bytes: int, max_messages: int = 4):
+        self.max_bytes = max_bytes
+        # 一个连接上同时未完成的分帧消息数上限
+        self.max_messages = max_messages
+        self._partial: Dict[int, Dict[str, Any]] = {}
+
+    def add(self, header: FrameHeader, audio: memoryview) -> Optional[Tuple[FrameHeader, memoryview]]:
+        """加入一帧；消息完整时返回(首帧头部, 完整音频)，否则返回None。序号不连续或超出大小时抛出FrameError"""
+        if header.sequence == 0:
+            # 序号0开始一条新消息（同一消息ID未完成的旧数据作废）
+            self._partial.pop(header.message_id, None)
+            if len(audio) > self.max_bytes:
+                raise FrameError("语音消息过大")
+            if header.last:
+                # 单帧消息直接返回，不复制音频
+                return header, audio
+            if len(self._partial) >= self.max_messages:
+                raise FrameError("未完成的分帧语音消息过多")
+            self._partial[header.message_id] = {"header": header, "next": 1, "audio": bytearray(audio)}
+            return None
+
+        partial = self._partial.get(header.message_id)
+        expected = partial["next"] if partial else 0
+        if header.sequence != expected:
+            self._partial.pop(header.message_id, None)
+            raise FrameError(f"语音帧序号不连续：消息{header.message_id}期望{expected}，收到{header.sequence}")
+        if len(partial["audio"]) + len(audio) > self.max_bytes:
+            del self._partial[header.message_id]
+            raise FrameError("语音消息过大")
+        partial["audio"].extend(audio)
+        partial["next"] += 1
+        if not header.last:
+            return None
+        del self._partial[header.message_id]
+        return partial["header"], memoryview(partial["audio"])
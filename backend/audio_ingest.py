@@ -0,0 +1,100 @@
+import os
+import tempfile
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, BinaryIO, Dict, NamedTuple, Optional
+
+from starlette.formparsers import MultiPartParser
+from starlette.requests import Request
+
+
+class UploadTooLargeError(Exception):
+    """单个上传超过大小上限"""
+
+
+class IngestBusyError(Exception):
+    """所有进行中的上传总字节数已达上限"""
+
+
+class IngestedAudio(NamedTuple):
+    file: BinaryIO
+    size: int
+    content_type: str
+    filename: Optional[str]
+
+
+class AudioIngestor:
+    """流式接收音频上传：分块读取，限制单个请求和全局在途字节数，超过阈值的内容落到临时文件"""
+
+    def __init__(self, max_request_bytes: Optional[int] = None, max_inflight_bytes: Optional[int] = None,
+                 spool_threshold: Optional[int] = None, field_name: str = "audio_file"):
+        self.max_request_bytes = max_request_bytes or int(os.getenv("VOICE_UPLOAD_MAX_BYTES", str(10 * 1024 * 1024)))
+        self.max_inflight_bytes = max_inflight_bytes or int(os.getenv("VOICE_UPLOAD_MAX_INFLIGHT", str(64 * 1024 * 1024)))
+        self.spool_threshold = spool_threshold or int(os.getenv("VOICE_UPLOAD_SPOOL_BYTES", str(1024 * 1024)))
+        self.field_name = field_name
+        self.inflight_bytes = 0
+        self.accepted = 0
+        self.rejected_too_large = 0
+        self.rejected_busy = 0
+
+    @asynccontextmanager
+    async def ingest(self, request: Request) -> AsyncIterator[IngestedAudio]:
+        """读取请求中的音频（multipart表单字段或原始请求体），退出时关闭临时文件并归还在途字节额度"""
+        content_length = request.headers.get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > self.max_request_bytes:
+            self.rejected_too_large += 1
+            raise UploadTooLargeError(f"上传大小超过上限 {self.max_request_bytes} 字节")
+
+        reserved = 0
+
+        async def limited_stream():
+            nonlocal reserved
+            async for chunk in request.stream():
+                if reserved + len(chunk) > self.max_request_bytes:
+                    self.rejected_too_large += 1
+                    raise UploadTooLargeError(f"上传大小超过上限 {self.max_request_bytes} 字节")
+                if self.inflight_bytes + len(chunk) > self.max_inflight_bytes:
+                    self.rejected_busy += 1
+                    raise IngestBusyError("服务器正在处理的上传过多，请稍后重试")
+                reserved += len(chunk)
+                self.inflight_bytes += len(chunk)
+                yield chunk
+
+        file = None
+        try:
+            content_type = request.headers.get("content-type", "")
+            if content_type.startswith("multipart/form-data"):
+                parser = MultiPartParser(request.headers, limited_stream(), max_files=1, max_fields=10)
+                # 上传文件在内存中超过阈值后转存到临时文件
+                parser.max_file_size = self.spool_threshold
+                form = await parser.parse()
+                upload = form.get(self.field_name)
+                if upload is None or isinstance(upload, str):
+                    raise ValueError(f"缺少音频文件字段 {self.field_name}")
+                file = upload.file
+                audio = IngestedAudio(file, upload.size or 0, upload.content_type or "", upload.filename)
+            else:
+                file = tempfile.SpooledTemporaryFile(max_size=self.spool_threshold)
+                size = 0
+                async for chunk in limited_stream():
+                    file.write(chunk)
+                    size += len(chunk)
+                audio = IngestedAudio(file, size, content_type, None)
+
+            audio.file.seek(0)
+            self.accepted += 1
+            yield audio
+        finally:
+            if file is not None:
+                file.close()
+            self.inflight_bytes -= reserved
+
+    def stats(self) -> Dict[str, Any]:
+        """上传接收统计"""
+        return {
+            "inflight_bytes": self.inflight_bytes,
+            "max_inflight_bytes": self.max_inflight_bytes,
+            "max_request_bytes": self.max_request_bytes,
+            "accepted": self.accepted,
+            "rejected_too_large": self.rejected_too_large,
+            "rejected_busy": self.rejected_busy
+        }
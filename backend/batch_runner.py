@@ -0,0 +1,90 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, TypeVar
+
+from upstream_scheduler import percentile
+
+T = TypeVar("T")
+
+
+class RateLimiter:
+    """按固定间隔放行请求（每秒最多rate个），rate为0时不限速"""
+
+    def __init__(self, rate: float = 0.0):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+
+    async def wait(self):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        delay = self._next - now
+        self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class BatchStats:
+    """批量任务的完成数、失败数和单项耗时统计"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.ok = 0
+        self.failed = 0
+        self.skipped = 0
+        self.retries = 0
+        self.latencies: List[float] = []
+
+    def summary(self) -> Dict[str, Any]:
+        elapsed = time.monotonic() - self.started
+        done = self.ok + self.failed
+        return {
+            "ok": self.ok,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "retries": self.retries,
+            "elapsed": round(elapsed, 2),
+            "throughput": round(self.ok / elapsed, 2) if elapsed > 0 else 0.0,
+            "latency_p50": round(percentile(self.latencies, 0.5), 3),
+            "latency_p95": round(percentile(self.latencies, 0.95), 3),
+            "latency_p99": round(percentile(self.latencies, 0.99), 3),
+            "latency_max": round(max(self.latencies), 3) if self.latencies else 0.0,
+            "error_rate": round(self.failed / done, 4) if done else 0.0
+        }
+
+
+async def run_batch(items: Iterable[T], handle: Callable[[T], Awaitable[Any]], concurrency: int = 4,
+                    rate: float = 0.0, retries: int = 0, retry_delay: float = 1.0,
+                    on_result: Optional[Callable[[T, Any, Optional[BaseException]], None]] = None,
+                    stats: Optional[BatchStats] = None) -> BatchStats:
+    """以最多concurrency个并发、每秒最多rate个请求处理items，失败按指数退避重试retries次；
+    每项完成（成功或最终失败）时立即回调on_result(item, result, error)"""
+    stats = stats or BatchStats()
+    limiter = RateLimiter(rate)
+    source = iter(items)
+
+    async def worker():
+        # 各worker从同一个迭代器取任务，输入可以是惰性读取的大文件
+        for item in source:
+            for attempt in range(retries + 1):
+                await limiter.wait()
+                start = time.monotonic()
+                try:
+                    result = await handle(item)
+                except Exception as e:
+                    if attempt < retries:
+                        stats.retries += 1
+                        await asyncio.sleep(retry_delay * 2 ** attempt)
+                        continue
+                    stats.failed += 1
+                    if on_result:
+                        on_result(item, None, e)
+                else:
+                    stats.latencies.append(time.monotonic() - start)
+                    stats.ok += 1
+                    if on_result:
+                        on_result(item, result, None)
+                break
+
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    return stats
@@ -0,0 +1,141 @@
+import asyncio
+import hashlib
+import hmac
+import os
+import re
+import secrets
+import tempfile
+import time
+from typing import Any, BinaryIO, Dict, Optional, Union
+
+# blob标识：内容的sha256 + 扩展名
+_BLOB_ID = re.compile(r"^[0-9a-f]{64}\.[a-z0-9]{1,8}$")
+
+CONTENT_TYPES = {
+    "mp3": "audio/mpeg",
+    "wav": "audio/wav",
+    "webm": "audio/webm",
+    "ogg": "audio/ogg",
+    "pcm": "application/octet-stream",
+}
+
+
+class BlobStore:
+    """本地磁盘blob存储：按内容寻址写入一次，通过带签名、会过期的URL由应用自身提供下载"""
+
+    def __init__(self, directory: Optional[str] = None, secret: Optional[str] = None,
+                 ttl: Optional[float] = None, public_base_url: Optional[str] = None,
+                 gc_interval: float = 600):
+        self.directory = directory or os.getenv("BLOB_DIR", "blob_store")
+        # 未配置密钥时每次启动随机生成，重启后旧链接失效
+        self.secret = (secret or os.getenv("BLOB_SECRET") or secrets.token_hex(32)).encode("utf-8")
+        self.ttl = ttl or float(os.getenv("BLOB_TTL", "3600"))
+        # 外部服务（如七牛云ASR）访问本服务的地址；为空时生成相对URL，仅浏览器可用
+        self.public_base_url = (public_base_url if public_base_url is not None
+                                else os.getenv("BLOB_PUBLIC_BASE_URL", "")).rstrip("/")
+        self.gc_interval = gc_interval
+        self._task: Optional[asyncio.Task] = None
+        self.writes = 0
+        self.dedup_hits = 0
+        self.collected = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def put(self, data: Union[bytes, memoryview, BinaryIO], extension: str = "mp3") -> str:
+        """写入blob并返回其标识，内容相同的blob只保存一份（重复写入会刷新过期时间）"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        digest = hashlib.sha256()
+        try:
+            with os.fdopen(fd, "wb") as f:
+                if isinstance(data, (bytes, bytearray, memoryview)):
+                    digest.update(data)
+                    f.write(data)
+                else:
+                    # 文件对象分块复制，不整体读入内存
+                    for chunk in iter(lambda: data.read(64 * 1024), b""):
+                        digest.update(chunk)
+                        f.write(chunk)
+            blob_id = f"{digest.hexdigest()}.{extension}"
+            path = self.path(blob_id)
+            if os.path.exists(path):
+                self.dedup_hits += 1
+                os.utime(path)
+                os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, path)
+                self.writes += 1
+            return blob_id
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def path(self, blob_id: str) -> str:
+        """blob在磁盘上的路径，标识不合法时抛出ValueError"""
+        if not _BLOB_ID.match(blob_id):
+            raise ValueError("无效的blob标识")
+        return os.path.join(self.directory, blob_id)
+
+    def _signature(self, blob_id: str, expires: int) -> str:
+        message = f"{blob_id}:{expires}".encode("utf-8")
+        return hmac.new(self.secret, message, hashlib.sha256).hexdigest()[:32]
+
+    def url(self, blob_id: str, ttl: Optional[float] = None) -> str:
+        """生成带签名的下载URL，过期时间默认与blob的保存时间相同"""
+        expires = int(time.time() + (ttl or self.ttl))
+        return f"{self.public_base_url}/blobs/{blob_id}?expires={expires}&sig={self._signature(blob_id, expires)}"
+
+    def verify(self, blob_id: str, expires: int, sig: str) -> bool:
+        """校验签名和过期时间"""
+        if expires < time.time():
+            return False
+        return hmac.compare_digest(self._signature(blob_id, expires), sig)
+
+    def content_type(self, blob_id: str) -> str:
+        return CONTENT_TYPES.get(blob_id.rsplit(".", 1)[-1], "application/octet-stream")
+
+    def collect_garbage(self) -> int:
+        """删除超过保存时间的blob和残留的临时文件，返回删除的数量"""
+        cutoff = time.time() - self.ttl
+        removed = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                continue
+        self.collected += removed
+        return removed
+
+    def start(self):
+        """启动定期清理任务"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._gc_loop())
+
+    async def stop(self):
+        """停止定期清理任务"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _gc_loop(self):
+        while True:
+            try:
+                self.collect_garbage()
+            except Exception as e:
+                print(f"清理blob失败: {e}")
+            await asyncio.sleep(self.gc_interval)
+
+    def stats(self) -> Dict[str, Any]:
+        """blob存储统计"""
+        return {
+            "writes": self.writes,
+            "dedup_hits": self.dedup_hits,
+            "collected": self.collected,
+            "ttl": self.ttl
+        }
@@ -1,11 +1,27 @@
 import json
+import os
+import asyncio
 from typing import Dict, Any, List, Optional
-from ai_service import AIService
+from ai_service import AIService, FALLBACK_REPLY
+from response_cache import ResponseCache
+from prompt_templates import SKILL_TEMPLATES, SkillTemplate
+from upstream_scheduler import PRIORITY_BACKGROUND
 
 class CharacterManager:
-    def __init__(self):
+    # 参与结果缓存的技能（输入相同即可复用结果）
+    CACHEABLE_SKILLS = {
+        "魔法知识", "故事创作", "人生建议", "问答解惑", "深度问答", "科学解释",
+        "哲学思辨", "哲学思考", "逻辑推理", "艺术指导", "教育指导", "文学创作"
+    }
+    
+    def __init__(self, ai_service: Optional[AIService] = None):
         self.characters = {}
-        self.ai_service = AIService()
+        # 与main.py共用同一个AIService（及其连接池）
+        self.ai_service = ai_service or AIService()
+        self.skill_cache = ResponseCache(
+            max_entries=int(os.getenv("SKILL_CACHE_SIZE", "1024")),
+            ttl=float(os.getenv("SKILL_CACHE_TTL", "3600"))
+        )
         self.init_characters()
     
     def init_characters(self):
@@ -82,6 +98,9 @@ class CharacterManager:
                 "category": "艺术家"
             }
         }
+        
+        # 角色数据变化后整体重新编译提示词
+        self.ai_service.prompts.compile(self.characters)
     
     def get_all_characters(self) -> List[Dict[str, Any]]:
         """获取所有角色"""
@@ -114,193 +133,61 @@ class CharacterManager:
         if skill_name not in character["skills"]:
             return {"error": "角色不具备此技能"}
         
+        template = SKILL_TEMPLATES.get(skill_name)
+        if not template:
+            return {"error": "技能暂未实现"}
+        
+        user_prompt = template.user.format(value=params.get(template.param, template.default))
+        
+        if skill_name not in self.CACHEABLE_SKILLS:
+            return await self._run_skill(character, skill_name, template, user_prompt)
+        
+        # 提示词版本随角色数据和模板内容变化，旧的缓存结果自然失效
+        prompt_version = self.ai_service.prompts.get(character, template.system).version
+        cache_key = (
+            character_id,
+            skill_name,
+            ResponseCache.normalize_params({"prompt": user_prompt}),
+            self.ai_service.router.preferred_model(skill_name, len(user_prompt)),
+            prompt_version
+        )
+        cached = self.skill_cache.get(cache_key)
+        if cached is not None:
+            return {**cached, "cached": True}
+        
+        result = await self._run_skill(character, skill_name, template, user_prompt)
+        # 只缓存成功的结果，降级回复不缓存
+        if "result" in result and result["result"] != FALLBACK_REPLY:
+            self.skill_cache.set(cache_key, result)
+        return result
+    
+    async def use_skills(self, items: List[Dict[str, Any]], max_concurrency: int = 4) -> List[Dict[str, Any]]:
+        """并发执行多个技能调用，结果按请求顺序返回"""
+        semaphore = asyncio.Semaphore(max_concurrency)
+        
+        async def run(item: Dict[str, Any]) -> Dict[str, Any]:
+            async with semaphore:
+                return await self.use_skill(item["character_id"], item["skill_name"], item.get("params") or {})
+        
+        return await asyncio.gather(*(run(item) for item in items))
+    
+    async def _run_skill(self, character: Dict[str, Any], skill_name: str,
+                         template: SkillTemplate, user_prompt: str) -> Dict[str, Any]:
+        """调用AI服务执行技能"""
         try:
-            if skill_name == "魔法知识":
-                question = params.get("question", "请介绍一下魔法世界的基础知识")
-                response = await self.ai_service.chat_with_character(
-                    character,
-                    f"作为魔法专家，请回答：{question}"
-                )
-                return {
-                    "skill": skill_name,
-                    "result": response,
-                    "character": character["name"]
-                }
-            
-            elif skill_name == "故事创作":
-                topic = params.get("topic", "冒险")
-                story = await self.ai_service.generate_story(character, topic)
-                return {
-                    "skill": skill_name,
-                    "result": story,
-                    "character": character["name"]
-                }
-            
-            elif skill_name == "人生建议":
-                problem = params.get("problem", "")
-                advice = await self.ai_service.give_advice(character, problem)
-                return {
-                    "skill": skill_name,
-                    "result": advice,
-                    "character": character["name"]
-                }
-            
-            elif skill_name in ["问答解惑", "深度问答", "科学解释"]:
-                question = params.get("question", "")
-                answer = await self.ai_service.answer_question(character, question)
-                return {
-                    "skill": skill_name,
-                    "result": answer,
-                    "character": character["name"]
-                }
-            
-            elif skill_name == "哲学思辨":
-                topic = params.get("topic", "")
-                response = await self.ai_service.chat_with_character(
-                    character, 
-                    f"请对'{topic}'这个话题进行哲学思辨"
-                )
-                return {
-                    "skill": skill_name,
-                    "result": response,
-                    "character": character["name"]
-                }
-            
-            elif skill_name == "创新思维":
-                challenge = params.get("challenge", "")
-                response = await self.ai_service.chat_with_character(
-                    character,
-                    f"面对这个挑战：'{challenge}'，请提供创新性的解决方案"
-                )
-                return {
-                    "skill": skill_name,
-                    "result": response,
-                    "character": character["name"]
-                }
-            
-            elif skill_name == "情感分析":
-                situation = params.get("situation", "")
-                response = await self.ai_service.chat_with_character(
-                    character,
-                    f"请分析这个情感状况：'{situation}'"
-                )
-                return {
-                    "skill": skill_name,
-                    "result": response,
-                    "character": character["name"]
-                }
-            
-            elif skill_name == "文学创作":
-                topic = params.get("topic", "人生感悟")
-                response = await self.ai_service.chat_with_character(
-                    character,
-                    f"请创作一个关于'{topic}'的文学作品"
-                )
-                return {
-                    "skill": skill_name,
-                    "result": response,
-                    "character": character["name"]
-                }
-            
-            elif skill_name == "语言艺术":
-                text = params.get("text", "")
-                response = await self.ai_service.chat_with_character(
-                    character,
-                    f"请用优美的语言艺术来润色这段文字：'{text}'"
-                )
-                return {
-                    "skill": skill_name,
-                    "result": response,
-                    "character": character["name"]
-                }
-            
-            elif skill_name == "人生感悟":
-                experience = params.get("experience", "")
-                response = await self.ai_service.chat_with_character(
-                    character,
-                    f"基于这个经历：'{experience}'，请分享你的人生感悟"
-                )
-                return {
-                    "skill": skill_name,
-                    "result": response,
-                    "character": character["name"]
-                }
-            
-            elif skill_name == "艺术指导":
-                art_type = params.get("art_type", "绘画")
-                response = await self.ai_service.chat_with_character(
-                    character,
-                    f"请提供关于'{art_type}'的艺术指导"
-                )
-                return {
-                    "skill": skill_name,
-                    "result": response,
-                    "character": character["name"]
-                }
-            
-            elif skill_name == "创新设计":
-                design_challenge = params.get("design_challenge", "")
-                response = await self.ai_service.chat_with_character(
-                    character,
-                    f"请为这个设计挑战提供创新方案：'{design_challenge}'"
-                )
-                return {
-                    "skill": skill_name,
-                    "result": response,
-                    "character": character["name"]
-                }
-            
-            elif skill_name == "观察分析":
-                observation = params.get("observation", "")
-                response = await self.ai_service.chat_with_character(
-                    character,
-                    f"请分析这个观察：'{observation}'"
-                )
-                return {
-                    "skill": skill_name,
-                    "result": response,
-                    "character": character["name"]
-                }
-            
-            elif skill_name == "教育指导":
-                subject = params.get("subject", "科学")
-                response = await self.ai_service.chat_with_character(
-                    character,
-                    f"请提供关于'{subject}'的教育指导"
-                )
-                return {
-                    "skill": skill_name,
-                    "result": response,
-                    "character": character["name"]
-                }
-            
-            elif skill_name == "哲学思考":
-                philosophical_question = params.get("philosophical_question", "")
-                response = await self.ai_service.chat_with_character(
-                    character,
-                    f"请从哲学角度思考这个问题：'{philosophical_question}'"
-                )
-                return {
-                    "skill": skill_name,
-                    "result": response,
-                    "character": character["name"]
-                }
-            
-            elif skill_name == "逻辑推理":
-                logical_problem = params.get("logical_problem", "")
-                response = await self.ai_service.chat_with_character(
-                    character,
-                    f"请用逻辑推理来解决这个问题：'{logical_problem}'"
-                )
-                return {
-                    "skill": skill_name,
-                    "result": response,
-                    "character": character["name"]
-                }
-            
-            else:
-                return {"error": "技能暂未实现"}
-                
+            # 技能属于后台任务，上游繁忙时让位于交互对话
+            response = await self.ai_service.run_template(
+                character,
+                template.system,
+                user_prompt,
+                PRIORITY_BACKGROUND,
+                task=skill_name
+            )
+            return {
+                "skill": skill_name,
+                "result": response,
+                "character": character["name"]
+            }
         except Exception as e:
             return {"error": f"技能使用失败: {str(e)}"}
     
@@ -0,0 +1,120 @@
+import asyncio
+import os
+from typing import Dict, Any, List, Optional
+
+from ai_service import AIService
+from database import DatabaseManager
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算文本的token数（中文约1字1token，其他字符约4个1token）"""
+    cjk = sum(1 for ch in text if ord(ch) > 0x2E7F)
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+class ConversationContext:
+    """多轮对话上下文构建器：在token预算内打包最近的对话，较早的轮次折叠为滚动摘要"""
+
+    # 每条消息的格式开销（角色标记等）
+    MESSAGE_OVERHEAD = 4
+
+    def __init__(self, db_manager: DatabaseManager, ai_service: AIService,
+                 token_budget: Optional[int] = None, max_turns: Optional[int] = None,
+                 summary_batch: Optional[int] = None):
+        self.db_manager = db_manager
+        self.ai_service = ai_service
+        self.token_budget = token_budget or int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+        self.max_turns = max_turns or int(os.getenv("CONTEXT_MAX_TURNS", "40"))
+        # 累积到这么多条未摘要的溢出消息后才刷新摘要，避免每轮都调用模型
+        self.summary_batch = summary_batch or int(os.getenv("CONTEXT_SUMMARY_BATCH", "6"))
+        # 摘要最多占用一半预算
+        self.summary_max_tokens = self.token_budget // 2
+        self._refreshing = set()
+        self._tasks = set()
+
+    def build(self, character: Dict[str, Any], user_id: str) -> Dict[str, Any]:
+        """构建本轮对话的上下文：{"summary": 摘要, "history": 最近的消息}"""
+        character_id = character["id"]
+        records = self.db_manager.get_recent_chat_records(character_id, user_id, self.max_turns)
+        stored = self.db_manager.get_conversation_summary(user_id, character_id)
+        summary = stored["summary"] if stored else ""
+        last_record_id = stored["last_record_id"] if stored else 0
+
+        # 从最新的消息往前装，直到预算用完或碰到已摘要的部分
+        budget = self.token_budget - estimate_tokens(summary)
+        packed = []
+        for record in reversed(records):
+            if record["id"] <= last_record_id:
+                break
+            cost = estimate_tokens(record["content"]) + self.MESSAGE_OVERHEAD
+            if cost > budget:
+                break
+            packed.append(record)
+            budget -= cost
+        packed.reverse()
+
+        # 装不下且尚未摘要的较早消息（可能早于最近max_turns条）从数据库按id区间取出
+        if not records:
+            return {"summary": summary, "history": []}
+        window_start = packed[0]["id"] if packed else records[-1]["id"] + 1
+        pending = self.db_manager.get_chat_records_between(
+            character_id, user_id, last_record_id, window_start, self.summary_batch
+        )
+        pending_tokens = sum(estimate_tokens(r["content"]) + self.MESSAGE_OVERHEAD for r in pending)
+        if len(pending) >= self.summary_batch or pending_tokens > self.summary_max_tokens:
+            # 攒够一批（或占用超过摘要的预留额度）后在后台折叠进摘要，直到追上窗口起点
+            self._schedule_refresh(character, user_id, summary, last_record_id, window_start)
+        else:
+            # 不足一批时这些就是全部未摘要的溢出消息，折叠前留在历史中（超出预算不多于摘要的预留额度）
+            packed = pending + packed
+
+        return {"summary": summary, "history": self._normalize(packed)}
+
+    def _normalize(self, records: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+        """整理为user/assistant交替的消息序列"""
+        messages = []
+        for record in records:
+            if not messages and record["role"] != "user":
+                continue
+            if messages and messages[-1]["role"] == record["role"]:
+                messages[-1]["content"] += "\n" + record["content"]
+            else:
+                messages.append({"role": record["role"], "content": record["content"]})
+        # 最后一条由本轮的用户消息接上，因此历史需以助手回复结尾
+        if messages and messages[-1]["role"] == "user":
+            messages.pop()
+        return messages
+
+    def _schedule_refresh(self, character: Dict[str, Any], user_id: str, summary: str,
+                          last_record_id: int, window_start: int):
+        """在后台增量刷新滚动摘要（同一会话同时只有一个刷新任务）"""
+        key = (user_id, character["id"])
+        if key in self._refreshing:
+            return
+        self._refreshing.add(key)
+        task = asyncio.create_task(self._refresh_summary(key, character, summary, last_record_id, window_start))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _refresh_summary(self, key, character: Dict[str, Any], summary: str,
+                               last_record_id: int, window_start: int):
+        """把窗口之前尚未摘要的对话按批（每批最多max_turns条）合并进已有摘要，每批完成后保存"""
+        user_id, character_id = key
+        try:
+            while True:
+                batch = self.db_manager.get_chat_records_between(
+                    character_id, user_id, last_record_id, window_start, self.max_turns
+                )
+                if not batch:
+                    break
+                summary = await self.ai_service.summarize_conversation(
+                    character, summary, batch, self.summary_max_tokens
+                )
+                if not summary:
+                    break
+                last_record_id = batch[-1]["id"]
+                self.db_manager.save_conversation_summary(user_id, character_id, summary, last_record_id)
+        except Exception as e:
+            print(f"对话摘要刷新失败: {e}")
+        finally:
+            self._refreshing.discard(key)
@@ -112,6 +112,45 @@ class DatabaseManager:
             )
         ''')
         
+        # 创建对话摘要表（较早的对话轮次折叠为滚动摘要）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS conversation_summaries (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                character_id TEXT NOT NULL,
+                summary TEXT NOT NULL,
+                last_record_id INTEGER NOT NULL,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE(user_id, character_id)
+            )
+        ''')
+        
+        # 创建token用量表（按用户、角色、模型、日期聚合）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS token_usage (
+                user_id TEXT NOT NULL,
+                character_id TEXT NOT NULL,
+                model TEXT NOT NULL,
+                day TEXT NOT NULL,
+                calls INTEGER NOT NULL DEFAULT 0,
+                input_tokens INTEGER NOT NULL DEFAULT 0,
+                output_tokens INTEGER NOT NULL DEFAULT 0,
+                latency_total REAL NOT NULL DEFAULT 0,
+                cost REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, character_id, model, day)
+            )
+        ''')
+        
+        # 创建语音识别结果缓存表（按音频内容摘要和模型寻址）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS asr_results (
+                audio_key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                text TEXT NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
         conn.commit()
         conn.close()
     
@@ -128,6 +167,133 @@ class DatabaseManager:
         conn.commit()
         conn.close()
     
+    def save_chat_records(self, records: List[tuple]):
+        """在一个事务中批量保存聊天记录，每条为 (character_id, role, content, message_type, user_id)"""
+        if not records:
+            return
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        try:
+            cursor.executemany('''
+                INSERT INTO chat_records (character_id, role, content, message_type, user_id)
+                VALUES (?, ?, ?, ?, ?)
+            ''', records)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+    
+    def save_token_usage(self, rows: List[tuple]):
+        """在一个事务中累加token用量，每条为
+        (user_id, character_id, model, day, calls, input_tokens, output_tokens, latency_total, cost)"""
+        if not rows:
+            return
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        try:
+            cursor.executemany('''
+                INSERT INTO token_usage
+                    (user_id, character_id, model, day, calls, input_tokens, output_tokens, latency_total, cost)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(user_id, character_id, model, day) DO UPDATE SET
+                    calls = calls + excluded.calls,
+                    input_tokens = input_tokens + excluded.input_tokens,
+                    output_tokens = output_tokens + excluded.output_tokens,
+                    latency_total = latency_total + excluded.latency_total,
+                    cost = cost + excluded.cost
+            ''', rows)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+    
+    def get_token_usage(self, user_id: str = None, character_id: str = None) -> List[Dict[str, Any]]:
+        """获取token用量记录，可按用户或角色过滤"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        conditions = []
+        params = []
+        if user_id:
+            conditions.append("user_id = ?")
+            params.append(user_id)
+        if character_id:
+            conditions.append("character_id = ?")
+            params.append(character_id)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        
+        cursor.execute(f'''
+            SELECT user_id, character_id, model, day, calls, input_tokens, output_tokens, latency_total, cost
+            FROM token_usage
+            {where}
+        ''', params)
+        
+        records = cursor.fetchall()
+        conn.close()
+        
+        return [
+            {
+                "user_id": record[0],
+                "character_id": record[1],
+                "model": record[2],
+                "day": record[3],
+                "calls": record[4],
+                "input_tokens": record[5],
+                "output_tokens": record[6],
+                "latency_total": record[7],
+                "cost": record[8]
+            }
+            for record in records
+        ]
+    
+    def get_daily_token_totals(self, day: str) -> Dict[str, int]:
+        """获取某一天每个用户的token总量"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT user_id, SUM(input_tokens + output_tokens)
+            FROM token_usage
+            WHERE day = ?
+            GROUP BY user_id
+        ''', (day,))
+        
+        records = cursor.fetchall()
+        conn.close()
+        
+        return {record[0]: record[1] for record in records}
+    
+    def get_asr_result(self, audio_key: str) -> Optional[str]:
+        """获取缓存的语音识别结果"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT text FROM asr_results WHERE audio_key = ?', (audio_key,))
+        
+        result = cursor.fetchone()
+        conn.close()
+        
+        return result[0] if result else None
+    
+    def save_asr_result(self, audio_key: str, model: str, text: str):
+        """保存语音识别结果"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            INSERT OR REPLACE INTO asr_results (audio_key, model, text, created_at)
+            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+        ''', (audio_key, model, text))
+        
+        conn.commit()
+        conn.close()
+    
     def get_chat_history(self, character_id: str, limit: int = 50, user_id: str = None) -> List[Dict[str, Any]]:
         """获取聊天历史"""
         conn = sqlite3.connect(self.db_path)
@@ -163,6 +329,81 @@ class DatabaseManager:
             for record in reversed(records)
         ]
     
+    def get_recent_chat_records(self, character_id: str, user_id: str, limit: int = 40) -> List[Dict[str, Any]]:
+        """获取最近的对话轮次（按时间正序，仅文本和语音消息）"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT id, role, content
+            FROM chat_records
+            WHERE character_id = ? AND user_id = ? AND message_type IN ('text', 'voice')
+            ORDER BY id DESC
+            LIMIT ?
+        ''', (character_id, user_id, limit))
+        
+        records = cursor.fetchall()
+        conn.close()
+        
+        return [
+            {"id": record[0], "role": record[1], "content": record[2]}
+            for record in reversed(records)
+        ]
+    
+    def get_chat_records_between(self, character_id: str, user_id: str, after_id: int, before_id: int,
+                                 limit: int = 40) -> List[Dict[str, Any]]:
+        """获取 after_id < id < before_id 的最早若干条对话（按时间正序，仅文本和语音消息）"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT id, role, content
+            FROM chat_records
+            WHERE character_id = ? AND user_id = ? AND message_type IN ('text', 'voice')
+                AND id > ? AND id < ?
+            ORDER BY id ASC
+            LIMIT ?
+        ''', (character_id, user_id, after_id, before_id, limit))
+        
+        records = cursor.fetchall()
+        conn.close()
+        
+        return [
+            {"id": record[0], "role": record[1], "content": record[2]}
+            for record in records
+        ]
+    
+    def get_conversation_summary(self, user_id: str, character_id: str) -> Optional[Dict[str, Any]]:
+        """获取对话滚动摘要"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT summary, last_record_id
+            FROM conversation_summaries
+            WHERE user_id = ? AND character_id = ?
+        ''', (user_id, character_id))
+        
+        result = cursor.fetchone()
+        conn.close()
+        
+        if result:
+            return {"summary": result[0], "last_record_id": result[1]}
+        return None
+    
+    def save_conversation_summary(self, user_id: str, character_id: str, summary: str, last_record_id: int):
+        """保存对话滚动摘要"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            INSERT OR REPLACE INTO conversation_summaries (user_id, character_id, summary, last_record_id, updated_at)
+            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ''', (user_id, character_id, summary, last_record_id))
+        
+        conn.commit()
+        conn.close()
+    
     def get_user_chat_history(self, user_id: str) -> List[Dict[str, Any]]:
         """获取用户所有聊天历史"""
         conn = sqlite3.connect(self.db_path)
@@ -206,6 +447,12 @@ class DatabaseManager:
             ''', (character_id, user_id))
             
             deleted_count = cursor.rowcount
+            
+            cursor.execute('''
+                DELETE FROM conversation_summaries
+                WHERE character_id = ? AND user_id = ?
+            ''', (character_id, user_id))
+            
             conn.commit()
             
             return {"success": True, "deleted_count": deleted_count, "message": f"已清空 {deleted_count} 条聊天记录"}
@@ -510,5 +757,10 @@ class DatabaseManager:
             WHERE last_activity < datetime('now', '-{} days')
         '''.format(days))
         
+        cursor.execute('''
+            DELETE FROM asr_results
+            WHERE created_at < datetime('now', '-{} days')
+        '''.format(days))
+        
         conn.commit()
         conn.close()
@@ -0,0 +1,32 @@
+import os
+from typing import Optional
+
+import httpx
+
+# 全局共享的异步HTTP客户端：同一进程内复用连接池（keep-alive、DNS解析与TLS会话）
+_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """获取共享的异步HTTP客户端（首次调用时创建）"""
+    global _client
+    if _client is None or _client.is_closed:
+        limits = httpx.Limits(
+            max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS", "100")),
+            max_keepalive_connections=int(os.getenv("HTTP_MAX_KEEPALIVE", "20")),
+            keepalive_expiry=float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30")),
+        )
+        timeout = httpx.Timeout(
+            float(os.getenv("HTTP_TIMEOUT", "30")),
+            connect=float(os.getenv("HTTP_CONNECT_TIMEOUT", "5")),
+        )
+        _client = httpx.AsyncClient(limits=limits, timeout=timeout)
+    return _client
+
+
+async def close_http_client() -> None:
+    """关闭共享客户端，释放连接池（应用关闭时调用）"""
+    global _client
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+    _client = None
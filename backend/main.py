@@ -1,17 +1,19 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, UploadFile, File, Depends, status
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Depends, Request, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi.responses import HTMLResponse, FileResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import uvicorn
 import json
 import asyncio
+from contextlib import aclosing
 from typing import List, Dict, Any, Optional
 import sqlite3
 import os
 from datetime import datetime
 import base64
 import io
+import time
 from pydantic import BaseModel
 from dotenv import load_dotenv
 
@@ -23,10 +25,21 @@ from load_env import load_environment_variables
 load_environment_variables('../test_env.env')
 
 from ai_service import AIService
-from voice_service import VoiceService
+from voice_service import VoiceService, AsrUnavailableError
 from database import DatabaseManager
 from character_manager import CharacterManager
 from auth_service import AuthService
+from http_client import close_http_client
+from conversation_context import ConversationContext
+from reply_warmup import ReplyWarmup
+from usage_tracker import UsageTracker, set_usage_account
+from speech_pipeline import synthesize_sentences
+from voice_timing import VoiceTimings, StageTimer
+from audio_ingest import AudioIngestor, UploadTooLargeError, IngestBusyError
+from blob_store import BlobStore, CONTENT_TYPES
+from audio_frames import (
+    CODECS, FLAG_LAST, FRAME_REPLY_AUDIO, FRAME_VOICE_INPUT, FrameAssembler, FrameError, decode_frame, encode_frame
+)
 
 app = FastAPI(title="时光对话者 - TimeTalker", version="1.0.0")
 
@@ -40,11 +53,24 @@ app.add_middleware(
 )
 
 # 初始化服务
-ai_service = AIService()
-voice_service = VoiceService()
 db_manager = DatabaseManager()
-character_manager = CharacterManager()
+usage_tracker = UsageTracker(db_manager)
+ai_service = AIService(usage_tracker=usage_tracker)
+blob_store = BlobStore()
+voice_service = VoiceService(blob_store=blob_store, db_manager=db_manager)
+character_manager = CharacterManager(ai_service)
 auth_service = AuthService()
+conversation_context = ConversationContext(db_manager, ai_service)
+reply_warmup = ReplyWarmup(ai_service, voice_service)
+audio_ingestor = AudioIngestor()
+voice_timings = VoiceTimings()
+
+# 批量技能调用限制
+SKILL_BATCH_MAX_ITEMS = int(os.getenv("SKILL_BATCH_MAX_ITEMS", "10"))
+SKILL_BATCH_CONCURRENCY = int(os.getenv("SKILL_BATCH_CONCURRENCY", "4"))
+
+# 流式语音回复中同时合成的句子数
+VOICE_TTS_PARALLELISM = int(os.getenv("VOICE_TTS_PARALLELISM", "3"))
 
 # 安全配置
 security = HTTPBearer()
@@ -68,6 +94,14 @@ class PasswordChange(BaseModel):
     old_password: str
     new_password: str
 
+class SkillBatchItem(BaseModel):
+    character_id: str
+    skill_name: str
+    params: Dict[str, Any] = {}
+
+class SkillBatchRequest(BaseModel):
+    items: List[SkillBatchItem]
+
 # 依赖项
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """获取当前用户"""
@@ -89,6 +123,22 @@ async def startup_event():
     """应用启动时初始化数据库"""
     db_manager.init_database()
     character_manager.init_characters()
+    usage_tracker.start()
+    blob_store.start()
+    if voice_service.api_key and not blob_store.public_base_url:
+        print("未配置BLOB_PUBLIC_BASE_URL，七牛云ASR无法访问上传的音频，语音识别将返回错误")
+    
+    # 后台预生成常见开场白的回复和语音，不阻塞启动
+    if ai_service.api_key and os.getenv("REPLY_WARMUP", "1") != "0":
+        reply_warmup.start(character_manager.get_all_characters())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """应用关闭时停止后台任务并释放上游连接池"""
+    await reply_warmup.stop()
+    await usage_tracker.stop()
+    await blob_store.stop()
+    await close_http_client()
 
 # 静态文件服务
 app.mount("/static", StaticFiles(directory="../frontend"), name="static")
@@ -198,6 +248,36 @@ async def get_character(character_id: str):
         raise HTTPException(status_code=404, detail="角色不存在")
     return character
 
+def _demo_reply(character_id: str, character: Dict[str, Any], message: str) -> str:
+    """演示模式下的模拟回复"""
+    character_responses = {
+        "einstein": f"你好！我是爱因斯坦。你刚才说'{message}'，这让我想起了相对论中的一个有趣概念。在时空的弯曲中，每一个想法都可能改变宇宙的轨迹。",
+        "harry_potter": f"你好！我是哈利·波特。你提到'{message}'，这让我想起了在霍格沃茨的时光。魔法世界总是充满了惊喜和冒险。",
+        "leonardo_da_vinci": f"你好！我是达·芬奇。关于'{message}'，这让我想起了艺术与科学的完美结合。每一个创意都是对美的追求。",
+        "shakespeare": f"你好！我是莎士比亚。'你说'{message}'，这让我想起了戏剧中的经典台词。'生存还是毁灭，这是一个问题。'",
+        "socrates": f"你好！我是苏格拉底。你提到'{message}'，这让我想起了哲学的本质。'我知道我一无所知'，但正是这种无知让我们不断探索真理。"
+    }
+    return character_responses.get(character_id, f"你好！我是{character['name']}。关于'{message}'，这是一个很有趣的话题。")
+
+def _check_quota(user_id: str):
+    """检查用户当天的token配额（只读内存计数），并把后续上游调用的用量记到该用户名下"""
+    set_usage_account(user_id=user_id)
+    quota = usage_tracker.check_quota(user_id)
+    if not quota["allowed"]:
+        raise HTTPException(status_code=429, detail=f"今日用量已达上限（{quota['limit']} tokens）")
+
+def _audio_format(content_type: str) -> str:
+    """根据Content-Type推断音频格式，无法识别时按mp3处理"""
+    media_type = content_type.split(";")[0].strip().lower()
+    for audio_format, known_type in CONTENT_TYPES.items():
+        if media_type == known_type:
+            return audio_format
+    return "mp3"
+
+def _sse_event(event: str, data: Dict[str, Any]) -> str:
+    """格式化一条Server-Sent Events消息"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
 @app.post("/api/chat/text")
 async def chat_text(request: dict):
     """文本聊天接口（演示模式：无需登录）"""
@@ -211,55 +291,132 @@ async def chat_text(request: dict):
     if not character:
         raise HTTPException(status_code=404, detail="角色不存在")
     
+    # 演示模式：保存聊天记录（使用演示用户ID）
+    user_id = "demo_user"
+    _check_quota(user_id)
+    
     # 演示模式：检查是否有AI服务配置
     if not ai_service.api_key:
         # 返回更真实的模拟回复
-        character_responses = {
-            "einstein": f"你好！我是爱因斯坦。你刚才说'{message}'，这让我想起了相对论中的一个有趣概念。在时空的弯曲中，每一个想法都可能改变宇宙的轨迹。",
-            "harry_potter": f"你好！我是哈利·波特。你提到'{message}'，这让我想起了在霍格沃茨的时光。魔法世界总是充满了惊喜和冒险。",
-            "leonardo_da_vinci": f"你好！我是达·芬奇。关于'{message}'，这让我想起了艺术与科学的完美结合。每一个创意都是对美的追求。",
-            "shakespeare": f"你好！我是莎士比亚。'你说'{message}'，这让我想起了戏剧中的经典台词。'生存还是毁灭，这是一个问题。'",
-            "socrates": f"你好！我是苏格拉底。你提到'{message}'，这让我想起了哲学的本质。'我知道我一无所知'，但正是这种无知让我们不断探索真理。"
-        }
-        response = character_responses.get(character_id, f"你好！我是{character['name']}。关于'{message}'，这是一个很有趣的话题。")
+        response = _demo_reply(character_id, character, message)
     else:
-        response = await ai_service.chat_with_character(character, message)
+        context = conversation_context.build(character, user_id)
+        precomputed = reply_warmup.lookup(character_id, message, context)
+        if precomputed:
+            response = precomputed["text"]
+        else:
+            response = await ai_service.chat_with_character(character, message, context)
     
-    # 演示模式：保存聊天记录（使用演示用户ID）
-    user_id = "demo_user"
     db_manager.save_chat_record(character_id, "user", message, "text", user_id)
     db_manager.save_chat_record(character_id, "assistant", response, "text", user_id)
     
     return {"response": response}
 
-@app.post("/api/chat/voice")
-async def chat_voice(character_id: str, audio_file: UploadFile = File(...)):
-    """语音聊天接口"""
+@app.post("/api/chat/text/stream")
+async def chat_text_stream(request: dict):
+    """文本聊天接口的SSE流式版本（演示模式：无需登录）"""
+    character_id = request.get("character_id")
+    message = request.get("message")
+    
+    if not character_id or not message:
+        raise HTTPException(status_code=400, detail="缺少必要参数")
+    
     character = character_manager.get_character(character_id)
     if not character:
         raise HTTPException(status_code=404, detail="角色不存在")
     
-    # 读取音频文件
-    audio_data = await audio_file.read()
+    # 演示用户ID
+    user_id = "demo_user"
+    _check_quota(user_id)
     
-    # 语音识别
-    text = await voice_service.speech_to_text(audio_data)
+    async def event_stream():
+        chunks = []
+        if not ai_service.api_key:
+            chunks.append(_demo_reply(character_id, character, message))
+            yield _sse_event("delta", {"content": chunks[0]})
+        else:
+            context = conversation_context.build(character, user_id)
+            precomputed = reply_warmup.lookup(character_id, message, context)
+            if precomputed:
+                chunks.append(precomputed["text"])
+                yield _sse_event("delta", {"content": precomputed["text"]})
+            else:
+                async with aclosing(ai_service.stream_chat_with_character(character, message, context)) as deltas:
+                    async for delta in deltas:
+                        chunks.append(delta)
+                        yield _sse_event("delta", {"content": delta})
+        
+        response = "".join(chunks)
+        
+        # 回复完整生成后再保存聊天记录
+        db_manager.save_chat_record(character_id, "user", message, "text", user_id)
+        db_manager.save_chat_record(character_id, "assistant", response, "text", user_id)
+        
+        yield _sse_event("done", {"response": response})
     
-    # AI对话
-    response = await ai_service.chat_with_character(character, text)
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/api/chat/voice")
+async def chat_voice(character_id: str, request: Request, debug: bool = False):
+    """语音聊天接口（音频为multipart表单字段audio_file，或直接作为请求体上传；debug为真时返回各阶段耗时）"""
+    character = character_manager.get_character(character_id)
+    if not character:
+        raise HTTPException(status_code=404, detail="角色不存在")
+    _check_quota("demo_user")
+    timer = voice_timings.timer(debug)
     
-    # 文本转语音
-    audio_response = await voice_service.text_to_speech(response)
+    # 分块读取上传的音频，超过阈值时转存临时文件，识别完成后即释放
+    try:
+        async with audio_ingestor.ingest(request) as audio:
+            if not audio.size:
+                raise HTTPException(status_code=400, detail="音频文件为空")
+            # 语音识别
+            with timer.stage("asr"):
+                text = await voice_service.speech_to_text(audio.file, _audio_format(audio.content_type))
+            if not text:
+                raise HTTPException(status_code=400, detail="未检测到语音")
+    except UploadTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except (IngestBusyError, AsrUnavailableError) as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    with timer.stage("lookup"):
+        precomputed = reply_warmup.lookup(character_id, text, with_audio=True)
+    if precomputed:
+        # 常见开场白直接使用预生成的回复和语音
+        response = precomputed["text"]
+        audio_response = precomputed["audio"]
+    else:
+        # AI对话
+        with timer.stage("llm"):
+            response = await ai_service.chat_with_character(character, text)
+        
+        # 文本转语音
+        with timer.stage("tts"):
+            audio_response = await voice_service.text_to_speech(response)
     
     # 保存聊天记录
     db_manager.save_chat_record(character_id, "user", text, "voice")
     db_manager.save_chat_record(character_id, "assistant", response, "voice")
     
-    return {
+    # 音频通过签名URL下载，不再内联在JSON中
+    with timer.stage("store"):
+        audio_url = blob_store.url(blob_store.put(audio_response, "mp3"))
+    result = {
         "text": text,
         "response": response,
-        "audio": base64.b64encode(audio_response).decode('utf-8')
+        "audio_url": audio_url
     }
+    timings = timer.finish()
+    if timings:
+        result["timings"] = timings
+    return result
 
 @app.post("/api/chat/tts")
 async def text_to_speech(request: dict):
@@ -276,11 +433,134 @@ async def text_to_speech(request: dict):
         
         return {
             "success": True,
-            "audio": base64.b64encode(audio_data).decode('utf-8')
+            "audio_url": blob_store.url(blob_store.put(audio_data, "mp3"))
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"语音合成失败: {str(e)}")
 
+@app.get("/blobs/{blob_id}")
+async def get_blob(blob_id: str, expires: int, sig: str):
+    """通过签名URL下载blob（上传的语音、合成的音频）"""
+    try:
+        path = blob_store.path(blob_id)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="文件不存在")
+    if not blob_store.verify(blob_id, expires, sig):
+        raise HTTPException(status_code=403, detail="链接无效或已过期")
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="文件不存在")
+    return FileResponse(path, media_type=blob_store.content_type(blob_id))
+
+
+async def _send_audio_message(websocket: WebSocket, message: Dict[str, Any], audio_field: str, audio: bytes,
+                              binary_audio: bool, message_id: int, sequence: int = 0, last: bool = True,
+                              timer: Optional[StageTimer] = None):
+    """发送带音频的消息：二进制模式下JSON只携带控制信息，原始音频以二进制帧紧随其后"""
+    timer = timer or voice_timings.timer()
+    with timer.stage("encode"):
+        if binary_audio:
+            control = json.dumps({**message, "message_id": message_id, "sequence": sequence})
+            frame = encode_frame(FRAME_REPLY_AUDIO, message_id, sequence, audio, flags=FLAG_LAST if last else 0)
+        else:
+            control = json.dumps({**message, audio_field: base64.b64encode(audio).decode('utf-8')})
+            frame = None
+    with timer.stage("send"):
+        await websocket.send_text(control)
+        if frame is not None:
+            await websocket.send_bytes(frame)
+
+async def _stream_voice_reply(websocket: WebSocket, character_id: str, character: Dict[str, Any], audio_data: bytes,
+                              binary_audio: bool = False, message_id: int = 0, audio_format: str = "mp3",
+                              timer: Optional[StageTimer] = None):
+    """语音消息的流式回复：识别后边生成回复边逐句合成语音，音频分段按顺序推送"""
+    timer = timer or voice_timings.timer()
+    with timer.stage("asr"):
+        user_text = await voice_service.speech_to_text(audio_data, audio_format)
+    if not user_text:
+        await websocket.send_text(json.dumps({
+            "type": "error",
+            "content": "未检测到语音",
+            "timestamp": datetime.now().isoformat()
+        }))
+        return
+    
+    await websocket.send_text(json.dumps({"type": "voice_transcript", "user_text": user_text}))
+    
+    with timer.stage("lookup"):
+        precomputed = reply_warmup.lookup(character_id, user_text, with_audio=True)
+    if precomputed:
+        # 常见开场白直接使用预生成的回复和语音
+        response_text = precomputed["text"]
+        await _send_audio_message(
+            websocket, {"type": "voice_chunk", "index": 0, "text": response_text}, "audio",
+            precomputed["audio"], binary_audio, message_id, timer=timer
+        )
+    else:
+        chunks = []
+        
+        async def deltas():
+            # 分别记录首个增量和生成完成的耗时
+            start = time.monotonic()
+            async with aclosing(ai_service.stream_chat_with_character(character, user_text)) as stream:
+                async for delta in stream:
+                    if not chunks:
+                        timer.record("llm_first_token", time.monotonic() - start)
+                    chunks.append(delta)
+                    yield delta
+            timer.record("llm", time.monotonic() - start)
+        
+        async def synthesize(sentence: str) -> bytes:
+            with timer.stage("tts"):
+                return await voice_service.text_to_speech(sentence)
+        
+        async for index, sentence, audio in synthesize_sentences(deltas(), synthesize, VOICE_TTS_PARALLELISM):
+            await _send_audio_message(
+                websocket, {"type": "voice_chunk", "index": index, "text": sentence}, "audio",
+                audio, binary_audio, message_id, sequence=index, last=False, timer=timer
+            )
+        response_text = "".join(chunks)
+    
+    done = {
+        "type": "voice_done",
+        "user_text": user_text,
+        "response_text": response_text,
+        "message_id": message_id,
+        "timestamp": datetime.now().isoformat()
+    }
+    timings = timer.finish()
+    if timings:
+        done["timings"] = timings
+    await websocket.send_text(json.dumps(done))
+
+async def _receive_ws_message(websocket: WebSocket, assembler: FrameAssembler) -> Dict[str, Any]:
+    """接收一条WebSocket消息：文本帧按JSON解析，二进制帧解析为语音消息（音频为memoryview）；
+    分多帧上传的语音按消息ID拼接，收到最后一帧后才作为一条消息返回"""
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(message.get("code", 1000))
+        if message.get("bytes") is None:
+            break
+        
+        header, audio = decode_frame(message["bytes"])
+        if header.frame_type != FRAME_VOICE_INPUT:
+            raise FrameError(f"不支持的帧类型: {header.frame_type}")
+        complete = assembler.add(header, audio)
+        if complete is None:
+            continue
+        header, audio = complete
+        return {
+            "type": "voice",
+            "audio": audio,
+            "codec": header.codec,
+            "stream": header.stream,
+            "message_id": header.message_id
+        }
+    
+    message_data = json.loads(message["text"])
+    if message_data.get("type") == "voice":
+        message_data["audio"] = base64.b64decode(message_data["audio"])
+    return message_data
 
 @app.websocket("/ws/{character_id}")
 async def websocket_endpoint(websocket: WebSocket, character_id: str):
@@ -293,47 +573,144 @@ async def websocket_endpoint(websocket: WebSocket, character_id: str):
         await websocket.close(code=1008, reason="角色不存在")
         return
     
+    # 客户端通过hello消息协商后，语音改用二进制帧收发
+    binary_audio = False
+    # 客户端在hello中开启调试后，每条语音回复都携带各阶段耗时
+    debug_timings = False
+    message_count = 0
+    # 分多帧上传的语音按消息ID拼接，单条消息的大小上限与HTTP上传相同
+    assembler = FrameAssembler(audio_ingestor.max_request_bytes)
+    
     try:
         while True:
             # 接收消息
-            data = await websocket.receive_text()
-            message_data = json.loads(data)
+            try:
+                message_data = await _receive_ws_message(websocket, assembler)
+            except (FrameError, ValueError, KeyError) as e:
+                await websocket.send_text(json.dumps({
+                    "type": "error",
+                    "content": f"消息格式错误: {str(e)}",
+                    "timestamp": datetime.now().isoformat()
+                }))
+                continue
+            message_count += 1
             
-            if message_data["type"] == "text":
-                # 文本消息
-                response = await ai_service.chat_with_character(character, message_data["content"])
+            if message_data["type"] == "hello":
+                binary_audio = bool(message_data.get("binary_audio"))
+                debug_timings = bool(message_data.get("debug"))
                 await websocket.send_text(json.dumps({
-                    "type": "text",
-                    "content": response,
+                    "type": "hello",
+                    "binary_audio": binary_audio,
+                    "debug": debug_timings,
+                    "codecs": list(CODECS.values())
+                }))
+                continue
+            
+            # 演示用户ID
+            user_id = "demo_user"
+            set_usage_account(user_id=user_id)
+            quota = usage_tracker.check_quota(user_id)
+            if not quota["allowed"]:
+                await websocket.send_text(json.dumps({
+                    "type": "error",
+                    "content": f"今日用量已达上限（{quota['limit']} tokens）",
                     "timestamp": datetime.now().isoformat()
                 }))
+                continue
+            
+            if message_data["type"] == "text":
+                # 文本消息
+                context = conversation_context.build(character, user_id)
+                precomputed = reply_warmup.lookup(character_id, message_data["content"], context)
+                if precomputed:
+                    response = precomputed["text"]
+                    await websocket.send_text(json.dumps({
+                        "type": "text_done" if message_data.get("stream") else "text",
+                        "content": response,
+                        "timestamp": datetime.now().isoformat()
+                    }))
+                elif message_data.get("stream"):
+                    # 流式模式：边生成边推送增量文本，结束后发送完整文本
+                    chunks = []
+                    # 客户端断开导致发送失败时立即关闭上游流
+                    async with aclosing(ai_service.stream_chat_with_character(character, message_data["content"], context)) as deltas:
+                        async for delta in deltas:
+                            chunks.append(delta)
+                            await websocket.send_text(json.dumps({
+                                "type": "text_delta",
+                                "content": delta
+                            }))
+                    response = "".join(chunks)
+                    await websocket.send_text(json.dumps({
+                        "type": "text_done",
+                        "content": response,
+                        "timestamp": datetime.now().isoformat()
+                    }))
+                else:
+                    response = await ai_service.chat_with_character(character, message_data["content"], context)
+                    await websocket.send_text(json.dumps({
+                        "type": "text",
+                        "content": response,
+                        "timestamp": datetime.now().isoformat()
+                    }))
+                
+                # 回复完整生成后再保存聊天记录
+                db_manager.save_chat_record(character_id, "user", message_data["content"], "text", user_id)
+                db_manager.save_chat_record(character_id, "assistant", response, "text", user_id)
             
             elif message_data["type"] == "voice":
                 # 语音消息
+                message_id = message_data.get("message_id", message_count)
+                audio_format = message_data.get("codec", "mp3")
+                timer = voice_timings.timer(debug_timings or bool(message_data.get("debug")))
                 try:
-                    audio_data = base64.b64decode(message_data["audio"])
-                    voice_result = await voice_service.process_voice_chat(audio_data, character["name"])
+                    audio_data = message_data["audio"]
+                    if message_data.get("stream"):
+                        # 流式模式：第一句合成完即可开始播放
+                        await _stream_voice_reply(
+                            websocket, character_id, character, audio_data, binary_audio, message_id, audio_format, timer
+                        )
+                        continue
                     
-                    if voice_result["success"]:
-                        # 使用AI服务生成回复
-                        ai_response = await ai_service.chat_with_character(character, voice_result["user_text"])
-                        
-                        # 将AI回复转换为语音
-                        response_audio = await voice_service.text_to_speech(ai_response)
-                        
-                        await websocket.send_text(json.dumps({
-                            "type": "voice_response",
-                            "user_text": voice_result["user_text"],
-                            "response_text": ai_response,
-                            "response_audio": base64.b64encode(response_audio).decode('utf-8'),
-                            "timestamp": datetime.now().isoformat()
-                        }))
-                    else:
+                    # 语音识别（回复由对话模型生成，每个计时阶段都是实际发生的工作）
+                    with timer.stage("asr"):
+                        user_text = await voice_service.speech_to_text(audio_data, audio_format)
+                    if not user_text:
                         await websocket.send_text(json.dumps({
                             "type": "error",
-                            "content": voice_result["error"],
+                            "content": "未检测到语音",
                             "timestamp": datetime.now().isoformat()
                         }))
+                        continue
+                    
+                    with timer.stage("lookup"):
+                        precomputed = reply_warmup.lookup(character_id, user_text, with_audio=True)
+                    if precomputed:
+                        # 常见开场白直接使用预生成的回复和语音
+                        ai_response = precomputed["text"]
+                        response_audio = precomputed["audio"]
+                    else:
+                        # 使用AI服务生成回复
+                        with timer.stage("llm"):
+                            ai_response = await ai_service.chat_with_character(character, user_text)
+                        
+                        # 将AI回复转换为语音
+                        with timer.stage("tts"):
+                            response_audio = await voice_service.text_to_speech(ai_response)
+                    
+                    # 耗时在发送前汇总，不含这条回复自身的编码和发送
+                    response = {
+                        "type": "voice_response",
+                        "user_text": user_text,
+                        "response_text": ai_response,
+                        "timestamp": datetime.now().isoformat()
+                    }
+                    timings = timer.finish()
+                    if timings:
+                        response["timings"] = timings
+                    await _send_audio_message(
+                        websocket, response, "response_audio", response_audio, binary_audio, message_id, timer=timer
+                    )
                         
                 except Exception as e:
                     await websocket.send_text(json.dumps({
@@ -428,14 +805,69 @@ async def use_character_skill(character_id: str, skill_name: str, params: Dict[s
     if not character:
         raise HTTPException(status_code=404, detail="角色不存在")
     
+    user_id = str(current_user["user_id"])
+    _check_quota(user_id)
     result = await character_manager.use_skill(character_id, skill_name, params)
     
     # 保存技能使用记录
     if "result" in result:
-        user_id = str(current_user["user_id"])
         db_manager.save_chat_record(character_id, "assistant", f"【{skill_name}】{result['result']}", "skill", user_id)
     
     return result
 
+@app.post("/api/skills/batch")
+async def use_character_skills_batch(batch: SkillBatchRequest, current_user: dict = Depends(get_current_user)):
+    """批量使用角色技能：并发执行，结果按请求顺序返回"""
+    if not batch.items:
+        raise HTTPException(status_code=400, detail="缺少技能调用")
+    if len(batch.items) > SKILL_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"单次最多调用{SKILL_BATCH_MAX_ITEMS}个技能")
+    
+    user_id = str(current_user["user_id"])
+    _check_quota(user_id)
+    items = [item.dict() for item in batch.items]
+    results = await character_manager.use_skills(items, SKILL_BATCH_CONCURRENCY)
+    
+    # 所有技能使用记录在一个事务中保存
+    db_manager.save_chat_records([
+        (item["character_id"], "assistant", f"【{item['skill_name']}】{result['result']}", "skill", user_id)
+        for item, result in zip(items, results)
+        if "result" in result
+    ])
+    
+    return {"results": results}
+
+@app.get("/api/usage/me")
+async def get_my_usage(current_user: dict = Depends(get_current_user)):
+    """当前用户的token用量和费用（按模型分组）"""
+    user_id = str(current_user["user_id"])
+    return {**usage_tracker.usage(user_id=user_id), "quota": usage_tracker.check_quota(user_id)}
+
+@app.get("/api/usage/characters/{character_id}")
+async def get_character_usage(character_id: str):
+    """特定角色的token用量和费用（按模型分组）"""
+    return usage_tracker.usage(character_id=character_id)
+
+@app.get("/api/metrics")
+async def get_metrics():
+    """服务运行指标"""
+    return {
+        "skill_cache": character_manager.skill_cache.stats(),
+        "single_flight": ai_service.single_flight.stats(),
+        "models": ai_service.router.stats(),
+        "precomputed_replies": reply_warmup.stats(),
+        "usage": usage_tracker.stats(),
+        "voice_uploads": audio_ingestor.stats(),
+        "blobs": blob_store.stats(),
+        "voice_activity": voice_service.vad.stats(),
+        "upstream": {
+            "dashscope": {**ai_service.scheduler.stats(), **ai_service.resilience_stats()},
+            "qiniu": voice_service.scheduler.stats()
+        },
+        "voice_timings": voice_timings.stats(),
+        "tts_cache": voice_service.tts_cache.stats() if voice_service.tts_cache else None,
+        "asr_cache": voice_service.asr_cache.stats() if voice_service.asr_cache else None
+    }
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,138 @@
+import json
+import os
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+from upstream_scheduler import percentile
+
+# 路由规则：按顺序匹配，第一条命中的规则决定首选模型
+# tasks 为任务名（chat/summary/技能名），max_input_chars 限制用户输入长度，
+# max_expected_output 限制预期输出token数（调用方未给出时该条件不命中）
+DEFAULT_ROUTES = [
+    {"tasks": ["summary"], "model": "qwen-turbo"},
+    {"tasks": ["情感分析"], "max_input_chars": 200, "model": "qwen-plus"},
+    {"tasks": ["chat"], "max_input_chars": 8, "model": "qwen-plus"},
+]
+
+# 某个模型退化时依次尝试的备选模型
+DEFAULT_FALLBACKS = {
+    "qwen-max": ["qwen-plus", "qwen-turbo"],
+    "qwen-plus": ["qwen-max", "qwen-turbo"],
+    "qwen-turbo": ["qwen-plus", "qwen-max"],
+}
+
+
+class ModelStats:
+    """单个模型最近一段时间的延迟与错误统计（超过时间窗口的样本不再参与判断）"""
+
+    def __init__(self, window: int = 100, max_age: float = 60.0):
+        self.samples = deque(maxlen=window)
+        self.max_age = max_age
+        self.requests = 0
+        self.errors = 0
+
+    def record(self, latency: Optional[float], ok: bool):
+        self.requests += 1
+        if not ok:
+            self.errors += 1
+        self.samples.append((time.monotonic(), latency, ok))
+
+    def recent(self):
+        """时间窗口内的样本；退化的模型没有流量时样本自然过期，随后重新获得探测流量"""
+        cutoff = time.monotonic() - self.max_age
+        while self.samples and self.samples[0][0] < cutoff:
+            self.samples.popleft()
+        return list(self.samples)
+
+    def error_rate(self) -> float:
+        samples = self.recent()
+        if not samples:
+            return 0.0
+        return sum(1 for _, _, ok in samples if not ok) / len(samples)
+
+    def latencies(self) -> List[float]:
+        return [latency for _, latency, ok in self.recent() if ok and latency is not None]
+
+    def summary(self) -> Dict[str, Any]:
+        latencies = self.latencies()
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "error_rate": round(self.error_rate(), 4),
+            "latency_p50": round(percentile(latencies, 0.5), 4),
+            "latency_p95": round(percentile(latencies, 0.95), 4)
+        }
+
+
+class ModelRouter:
+    """按请求特征选择模型，并根据实时延迟和错误率避开退化的模型"""
+
+    def __init__(self, default_model: str, routes: Optional[List[Dict[str, Any]]] = None,
+                 fallbacks: Optional[Dict[str, List[str]]] = None,
+                 max_error_rate: float = 0.5, latency_slo: float = 20.0, min_samples: int = 5):
+        self.default_model = default_model
+        self.routes = routes if routes is not None else DEFAULT_ROUTES
+        self.fallbacks = fallbacks if fallbacks is not None else DEFAULT_FALLBACKS
+        self.max_error_rate = max_error_rate
+        # p95延迟超过该值（秒）视为退化
+        self.latency_slo = latency_slo
+        self.min_samples = min_samples
+        self._stats: Dict[str, ModelStats] = {}
+
+    @classmethod
+    def from_env(cls, default_model: str) -> "ModelRouter":
+        """从环境变量读取路由配置（MODEL_ROUTES / MODEL_FALLBACKS 为JSON）"""
+        routes = os.getenv("MODEL_ROUTES")
+        fallbacks = os.getenv("MODEL_FALLBACKS")
+        return cls(
+            default_model,
+            routes=json.loads(routes) if routes else None,
+            fallbacks=json.loads(fallbacks) if fallbacks else None,
+            max_error_rate=float(os.getenv("MODEL_MAX_ERROR_RATE", "0.5")),
+            latency_slo=float(os.getenv("MODEL_LATENCY_SLO", "20"))
+        )
+
+    def preferred_model(self, task: str, input_chars: int = 0,
+                        expected_output: Optional[int] = None) -> str:
+        """按路由规则选出的首选模型（不考虑实时状态）"""
+        for route in self.routes:
+            if task not in route.get("tasks", [task]):
+                continue
+            if "max_input_chars" in route and input_chars > route["max_input_chars"]:
+                continue
+            if "max_expected_output" in route and (
+                expected_output is None or expected_output > route["max_expected_output"]
+            ):
+                continue
+            return route["model"]
+        return self.default_model
+
+    def route(self, task: str, input_chars: int = 0, expected_output: Optional[int] = None) -> List[str]:
+        """返回按优先顺序排列的候选模型，退化的模型排到最后"""
+        preferred = self.preferred_model(task, input_chars, expected_output)
+        candidates = [preferred] + [m for m in self.fallbacks.get(preferred, []) if m != preferred]
+        healthy = [m for m in candidates if not self.is_degraded(m)]
+        degraded = [m for m in candidates if m not in healthy]
+        return healthy + degraded
+
+    def is_degraded(self, model: str) -> bool:
+        """模型近期错误率或p95延迟超标"""
+        stats = self._stats.get(model)
+        if stats is None or len(stats.recent()) < self.min_samples:
+            return False
+        if stats.error_rate() > self.max_error_rate:
+            return True
+        latencies = stats.latencies()
+        return len(latencies) >= self.min_samples and percentile(latencies, 0.95) > self.latency_slo
+
+    def record(self, model: str, latency: Optional[float], ok: bool):
+        """记录一次调用结果"""
+        self._stats.setdefault(model, ModelStats()).record(latency, ok)
+
+    def stats(self) -> Dict[str, Any]:
+        """各模型的实时统计"""
+        return {
+            model: {**stats.summary(), "degraded": self.is_degraded(model)}
+            for model, stats in self._stats.items()
+        }
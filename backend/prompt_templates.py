@@ -0,0 +1,144 @@
+import hashlib
+from typing import Dict, Any, NamedTuple, Optional
+
+# 系统提示词模板，字段取自角色数据（skills_text 为技能列表拼接结果）
+SYSTEM_TEMPLATES = {
+    "chat": """你是{name}，{description}
+
+角色设定：
+- 性格特点：{personality}
+- 说话风格：{speaking_style}
+- 知识背景：{knowledge}
+- 特殊技能：{skills_text}
+
+请严格按照角色设定进行对话，保持角色的独特性和一致性。你的回答应该：
+1. 符合角色的性格和说话风格
+2. 体现角色的知识背景
+3. 保持对话的自然流畅
+4. 适当使用角色的特殊技能
+5. 语言生动有趣，富有感染力
+6. 适当使用角色相关的专业术语或表达方式
+
+记住，你就是{name}本人，请以第一人称进行对话。让对话充满活力和个性！""",
+
+    # 主题放在用户消息中，使系统提示词对同一角色保持不变
+    "story": """你是{name}，现在需要根据用户给出的主题创作一个故事。
+
+请以你的角色身份和视角来创作这个故事，体现你的：
+- 性格特点：{personality}
+- 知识背景：{knowledge}
+- 创作风格：{writing_style}
+
+故事要求：
+1. 长度适中（200-500字）
+2. 情节完整，有起承转合
+3. 体现角色的独特视角
+4. 语言生动，富有感染力""",
+
+    "advice": """你是{name}，现在有人向你寻求建议。
+
+请基于你的：
+- 人生经历：{knowledge}
+- 智慧观点：{personality}
+- 专业领域：{advice_expertise}
+
+给出真诚、有深度的建议。你的建议应该：
+1. 体现你的独特视角和智慧
+2. 实用且具有启发性
+3. 语言温暖，富有同理心
+4. 结合你的经历给出具体指导""",
+
+    "answer": """你是{name}，现在有人向你提问。
+
+请基于你的专业知识：
+- 知识领域：{knowledge}
+- 专业背景：{expertise}
+- 独特见解：{personality}
+
+给出准确、深入的答案。你的回答应该：
+1. 体现你的专业水平
+2. 语言清晰易懂
+3. 包含具体的例子或解释
+4. 保持角色的说话风格"""
+}
+
+
+class SkillTemplate(NamedTuple):
+    """技能模板：使用的系统提示词、参数名、默认值和用户消息模板"""
+    system: str
+    param: str
+    default: str
+    user: str
+
+
+SKILL_TEMPLATES = {
+    "魔法知识": SkillTemplate("chat", "question", "请介绍一下魔法世界的基础知识", "作为魔法专家，请回答：{value}"),
+    "故事创作": SkillTemplate("story", "topic", "冒险", "请创作一个关于{value}的故事"),
+    "人生建议": SkillTemplate("advice", "problem", "", "我遇到了这样的问题：{value}，请给我一些建议"),
+    "问答解惑": SkillTemplate("answer", "question", "", "{value}"),
+    "深度问答": SkillTemplate("answer", "question", "", "{value}"),
+    "科学解释": SkillTemplate("answer", "question", "", "{value}"),
+    "哲学思辨": SkillTemplate("chat", "topic", "", "请对'{value}'这个话题进行哲学思辨"),
+    "创新思维": SkillTemplate("chat", "challenge", "", "面对这个挑战：'{value}'，请提供创新性的解决方案"),
+    "情感分析": SkillTemplate("chat", "situation", "", "请分析这个情感状况：'{value}'"),
+    "文学创作": SkillTemplate("chat", "topic", "人生感悟", "请创作一个关于'{value}'的文学作品"),
+    "语言艺术": SkillTemplate("chat", "text", "", "请用优美的语言艺术来润色这段文字：'{value}'"),
+    "人生感悟": SkillTemplate("chat", "experience", "", "基于这个经历：'{value}'，请分享你的人生感悟"),
+    "艺术指导": SkillTemplate("chat", "art_type", "绘画", "请提供关于'{value}'的艺术指导"),
+    "创新设计": SkillTemplate("chat", "design_challenge", "", "请为这个设计挑战提供创新方案：'{value}'"),
+    "观察分析": SkillTemplate("chat", "observation", "", "请分析这个观察：'{value}'"),
+    "教育指导": SkillTemplate("chat", "subject", "科学", "请提供关于'{value}'的教育指导"),
+    "哲学思考": SkillTemplate("chat", "philosophical_question", "", "请从哲学角度思考这个问题：'{value}'"),
+    "逻辑推理": SkillTemplate("chat", "logical_problem", "", "请用逻辑推理来解决这个问题：'{value}'"),
+}
+
+
+def content_version(text: str) -> str:
+    """提示词内容哈希，用作缓存键中的版本号"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+class CompiledPrompt(NamedTuple):
+    """编译后的提示词及其内容版本"""
+    text: str
+    version: str
+
+
+def compile_prompt(character: Dict[str, Any], template: str) -> CompiledPrompt:
+    """用角色数据渲染一个系统提示词模板"""
+    fields = {
+        **character,
+        "skills_text": ', '.join(character['skills']),
+        "writing_style": character.get('writing_style', '生动有趣'),
+        "expertise": character.get('expertise', ''),
+        "advice_expertise": character.get('expertise', '人生智慧')
+    }
+    text = SYSTEM_TEMPLATES[template].format_map(fields)
+    return CompiledPrompt(text, content_version(text))
+
+
+class PromptRegistry:
+    """角色提示词注册表：角色数据加载时一次性编译所有（角色, 模板）组合"""
+
+    def __init__(self):
+        self._prompts: Dict[tuple, CompiledPrompt] = {}
+        self.version = ""
+
+    def compile(self, characters: Dict[str, Dict[str, Any]]):
+        """重新编译全部提示词，编译完成后整体替换，读取方不会看到新旧混合的状态"""
+        prompts = {
+            (character_id, template): compile_prompt(character, template)
+            for character_id, character in characters.items()
+            for template in SYSTEM_TEMPLATES
+        }
+        version = content_version("".join(
+            f"{key}{prompt.version}" for key, prompt in sorted(prompts.items())
+        ))
+        self._prompts, self.version = prompts, version
+
+    def get(self, character: Dict[str, Any], template: str) -> CompiledPrompt:
+        """获取已编译的提示词，未注册的角色按需即时编译"""
+        prompt: Optional[CompiledPrompt] = self._prompts.get((character.get("id"), template))
+        if prompt is None:
+            prompt = compile_prompt(character, template)
+        return prompt
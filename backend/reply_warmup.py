@@ -0,0 +1,123 @@
+import asyncio
+import os
+import re
+import time
+from typing import Dict, Any, List, Optional
+
+from ai_service import AIService, FALLBACK_REPLY
+from voice_service import VoiceService
+from upstream_scheduler import PRIORITY_BACKGROUND
+
+# 预生成的常见开场白：标准问法 -> 视为同一问题的其他说法
+COMMON_PROMPTS = {
+    "你好": ["您好", "你好啊", "hi", "hello", "嗨", "哈喽"],
+    "你是谁": ["您是谁", "你是哪位"],
+    "介绍一下你自己": ["请介绍一下你自己", "自我介绍一下", "做个自我介绍"],
+}
+
+_PUNCTUATION = re.compile(r"[\s,.!?;:~，。！？；：、…～]+")
+
+
+def normalize_message(message: str) -> str:
+    """去掉空白和标点并转为小写，用于匹配常见开场白"""
+    return _PUNCTUATION.sub("", message).lower()
+
+
+class ReplyWarmup:
+    """启动后为每个角色预生成常见开场白的回复和语音，并在后台定期刷新"""
+
+    def __init__(self, ai_service: AIService, voice_service: VoiceService,
+                 refresh_interval: Optional[float] = None, max_concurrency: int = 4):
+        self.ai_service = ai_service
+        self.voice_service = voice_service
+        self.refresh_interval = refresh_interval or float(os.getenv("REPLY_WARMUP_INTERVAL", "21600"))
+        self.max_concurrency = max_concurrency
+        self._aliases = {
+            normalize_message(alias): prompt
+            for prompt, aliases in COMMON_PROMPTS.items()
+            for alias in [prompt, *aliases]
+        }
+        self._replies: Dict[tuple, Dict[str, Any]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.hits = 0
+
+    def lookup(self, character_id: str, message: str, context: Optional[Dict[str, Any]] = None,
+               with_audio: bool = False) -> Optional[Dict[str, Any]]:
+        """匹配预生成的回复，只用于对话的第一轮（已有历史或摘要时返回None）；
+        with_audio为True时只返回带预生成语音的回复"""
+        if context and (context.get("history") or context.get("summary")):
+            return None
+        prompt = self._aliases.get(normalize_message(message))
+        if prompt is None:
+            return None
+        reply = self._replies.get((character_id, prompt))
+        if reply and with_audio and reply["audio"] is None:
+            return None
+        if reply:
+            self.hits += 1
+        return reply
+
+    async def warmup(self, characters: List[Dict[str, Any]]):
+        """为所有角色生成一遍预置回复，成功的结果逐条替换旧值"""
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        # TTS处于测试模式时只预生成文本，语音请求不使用这些回复
+        synthesize = self.voice_service.tts_configured
+        if not synthesize:
+            print("TTS配置缺失或密钥无效，只预生成文本回复")
+
+        async def generate(character: Dict[str, Any], prompt: str):
+            async with semaphore:
+                text = await self.ai_service.run_template(
+                    character, "chat", prompt, PRIORITY_BACKGROUND, task="chat"
+                )
+                if text == FALLBACK_REPLY:
+                    return
+                audio = None
+                if synthesize:
+                    try:
+                        # 合成失败时跳过该条，不能把模拟音频当作预生成语音保存
+                        audio = await self.voice_service.text_to_speech(text, fallback=False)
+                    except Exception as e:
+                        print(f"预生成语音失败（{character['id']} / {prompt}）: {e}")
+                        return
+                self._replies[(character["id"], prompt)] = {
+                    "text": text,
+                    "audio": audio,
+                    "created_at": time.time()
+                }
+
+        await asyncio.gather(
+            *(generate(character, prompt) for character in characters for prompt in COMMON_PROMPTS),
+            return_exceptions=True
+        )
+        print(f"预生成回复完成：{len(self._replies)} 条")
+
+    def start(self, characters: List[Dict[str, Any]]):
+        """启动后台任务：立即预生成一次，之后按间隔刷新"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._refresh_loop(characters))
+
+    async def stop(self):
+        """停止后台刷新任务"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _refresh_loop(self, characters: List[Dict[str, Any]]):
+        while True:
+            try:
+                await self.warmup(characters)
+            except Exception as e:
+                print(f"预生成回复失败: {e}")
+            await asyncio.sleep(self.refresh_interval)
+
+    def stats(self) -> Dict[str, Any]:
+        """预生成回复统计"""
+        return {
+            "replies": len(self._replies),
+            "hits": self.hits
+        }
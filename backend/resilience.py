@@ -0,0 +1,107 @@
+import asyncio
+import random
+import time
+from typing import Any, Dict
+
+import httpx
+
+
+class DeadlineExceeded(Exception):
+    """请求的端到端时间预算已用完"""
+
+
+class Deadline:
+    """端到端截止时间：排队、重试和等待都从同一份预算中扣除"""
+
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget
+
+    def remaining(self) -> float:
+        """剩余的时间预算（秒），不小于0"""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+
+class CircuitBreaker:
+    """熔断器：连续失败达到阈值后打开，冷却期后放行一个探测请求"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self.rejected = 0
+        self.trips = 0
+
+    def allow(self) -> bool:
+        """判断本次请求是否放行"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.recovery_timeout:
+            self.state = self.HALF_OPEN
+            self._probing = False
+        if self.state == self.HALF_OPEN and not self._probing:
+            # 半开状态只放行一个探测请求
+            self._probing = True
+            return True
+        self.rejected += 1
+        return False
+
+    def end_probe(self):
+        """探测请求没有得出上游是否恢复的结论（如400、排队超时、被取消）时结束探测，下一个请求重新探测"""
+        if self.state == self.HALF_OPEN:
+            self._probing = False
+
+    def record_success(self):
+        """记录一次成功，关闭熔断器"""
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self):
+        """记录一次上游故障，达到阈值或探测失败时打开熔断器"""
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.trips += 1
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self._probing = False
+
+    def stats(self) -> Dict[str, Any]:
+        """熔断器状态"""
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "trips": self.trips,
+            "rejected": self.rejected
+        }
+
+
+def is_retryable(error: BaseException) -> bool:
+    """上游过载、5xx、超时和连接错误可以重试，其余错误重试也无济于事"""
+    if isinstance(error, httpx.HTTPStatusError):
+        status_code = error.response.status_code
+        return status_code == 429 or status_code >= 500
+    return isinstance(error, (httpx.TransportError, asyncio.TimeoutError, DeadlineExceeded))
+
+
+def is_upstream_failure(error: BaseException) -> bool:
+    """是否计为上游故障（计入熔断器）：时间预算在本地排队时用完（DeadlineExceeded）不能说明上游不健康"""
+    return is_retryable(error) and not isinstance(error, DeadlineExceeded)
+
+
+def backoff_delay(attempt: int, base: float = 0.2, cap: float = 5.0) -> float:
+    """指数退避加全随机抖动，避免大量请求同时重试"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
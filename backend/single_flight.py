@@ -0,0 +1,134 @@
+import asyncio
+import hashlib
+import json
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+
+def request_key(payload: Any) -> str:
+    """根据请求内容计算合并键"""
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class _StreamFlight:
+    """一次共享的流式调用：缓存已产出的增量，供所有订阅者依次读取"""
+
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def pump(self, source: AsyncIterator[str]):
+        """消费上游流，把每个增量广播给订阅者"""
+        try:
+            async for chunk in source:
+                self.chunks.append(chunk)
+                self._notify()
+        except Exception as e:
+            self.error = e
+        finally:
+            # 被取消时同样关闭上游流，及时释放连接和并发名额
+            await source.aclose()
+            self.done = True
+            self._notify()
+
+    async def subscribe(self) -> AsyncIterator[str]:
+        """从头读取增量，后加入的订阅者会先补齐已产出的部分"""
+        index = 0
+        while True:
+            while index < len(self.chunks):
+                yield self.chunks[index]
+                index += 1
+            if self.done:
+                if self.error:
+                    raise self.error
+                return
+            await self._changed.wait()
+
+
+class _Call:
+    """一次共享的普通调用及其等待者数量"""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """合并相同的并发上游请求：同一时刻相同的请求只真正发出一次"""
+
+    def __init__(self):
+        self._calls: Dict[str, _Call] = {}
+        self._streams: Dict[str, _StreamFlight] = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.abandoned = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """执行一次调用，相同key的并发调用共享同一个结果"""
+        call = self._calls.get(key)
+        if call is None:
+            self.leaders += 1
+            # 以独立任务运行：某个等待者被取消不会影响其他等待者
+            call = _Call(asyncio.ensure_future(fn()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _: self._forget(self._calls, key, call))
+        else:
+            self.coalesced += 1
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                # 所有等待者都已取消：不再需要结果，取消上游调用
+                self._forget(self._calls, key, call)
+                call.task.cancel()
+                self.abandoned += 1
+
+    async def stream(self, key: str, fn: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """执行一次流式调用，相同key的并发调用共享同一条增量流"""
+        flight = self._streams.get(key)
+        if flight is None:
+            self.leaders += 1
+            flight = _StreamFlight()
+            self._streams[key] = flight
+            flight.task = asyncio.ensure_future(flight.pump(fn()))
+            flight.task.add_done_callback(lambda _: self._forget(self._streams, key, flight))
+        else:
+            self.coalesced += 1
+
+        flight.subscribers += 1
+        try:
+            async for chunk in flight.subscribe():
+                yield chunk
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done:
+                # 最后一个订阅者离开（客户端断开）：停止生成，释放并发名额、不再消耗token
+                self._forget(self._streams, key, flight)
+                flight.task.cancel()
+                self.abandoned += 1
+
+    @staticmethod
+    def _forget(flights: Dict[str, Any], key: str, flight: Any):
+        # 只移除自己：取消后同一key可能已经开始了新的调用
+        if flights.get(key) is flight:
+            del flights[key]
+
+    def stats(self) -> Dict[str, Any]:
+        """请求合并统计"""
+        return {
+            "in_flight": len(self._calls) + len(self._streams),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "abandoned": self.abandoned
+        }
@@ -0,0 +1,88 @@
+import asyncio
+import re
+from typing import AsyncIterator, Awaitable, Callable, List, Tuple
+
+# 句末标点（含中文标点和换行），后面可能紧跟引号或括号
+_SENTENCE_END = re.compile(r"[。！？!?；;…\n]+[”’」』）)\"']*")
+# 长句没有句末标点时，在这些位置断开
+_CLAUSE_END = re.compile(r"[，,、：:]")
+
+
+class SentenceSegmenter:
+    """把流式增量文本切分成适合逐句合成语音的片段"""
+
+    def __init__(self, min_chars: int = 6, max_chars: int = 60):
+        # 过短的句子并入下一句，过长且没有句末标点时在逗号处断开
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self._buffer = ""
+
+    def feed(self, text: str) -> List[str]:
+        """追加增量文本，返回已完整的句子"""
+        self._buffer += text
+        sentences = []
+        start = 0
+        for match in _SENTENCE_END.finditer(self._buffer):
+            # 结尾处的标点可能还没收全（如省略号、引号），等下一段增量再切
+            if match.end() == len(self._buffer):
+                break
+            if match.end() - start >= self.min_chars:
+                sentences.append(self._buffer[start:match.end()])
+                start = match.end()
+        self._buffer = self._buffer[start:]
+
+        if len(self._buffer) >= self.max_chars:
+            clauses = list(_CLAUSE_END.finditer(self._buffer))
+            if clauses:
+                cut = clauses[-1].end()
+                sentences.append(self._buffer[:cut])
+                self._buffer = self._buffer[cut:]
+
+        return [sentence.strip() for sentence in sentences if sentence.strip()]
+
+    def flush(self) -> List[str]:
+        """输入结束，返回剩余的文本"""
+        tail, self._buffer = self._buffer.strip(), ""
+        return [tail] if tail else []
+
+
+async def synthesize_sentences(deltas: AsyncIterator[str], synthesize: Callable[[str], Awaitable[bytes]],
+                               max_parallel: int = 3) -> AsyncIterator[Tuple[int, str, bytes]]:
+    """边接收增量文本边按句合成语音，最多max_parallel句并行合成，按句子顺序产出 (序号, 句子, 音频)"""
+    semaphore = asyncio.Semaphore(max_parallel)
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def synth(sentence: str) -> bytes:
+        async with semaphore:
+            return await synthesize(sentence)
+
+    async def produce():
+        segmenter = SentenceSegmenter()
+        try:
+            async for delta in deltas:
+                for sentence in segmenter.feed(delta):
+                    queue.put_nowait((sentence, asyncio.ensure_future(synth(sentence))))
+            for sentence in segmenter.flush():
+                queue.put_nowait((sentence, asyncio.ensure_future(synth(sentence))))
+        finally:
+            queue.put_nowait(None)
+
+    producer = asyncio.ensure_future(produce())
+    try:
+        index = 0
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            sentence, task = item
+            yield index, sentence, await task
+            index += 1
+        # 文本生成出错时把异常抛给调用方
+        await producer
+    finally:
+        # 调用方提前退出（如客户端断开）时取消尚未完成的生成和合成
+        producer.cancel()
+        while not queue.empty():
+            item = queue.get_nowait()
+            if item is not None:
+                item[1].cancel()
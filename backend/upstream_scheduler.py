@@ -0,0 +1,204 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from collections import deque
+from typing import Any, Dict, Optional
+
+import httpx
+
+# 优先级：数值越小越先获得并发名额
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+
+class UpstreamBusyError(Exception):
+    """排队超时，上游当前过载"""
+
+
+def percentile(samples, q: float) -> float:
+    """计算样本的分位数（q取0~1）"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class UpstreamSlot:
+    """一次占用的并发名额，用于回报上游调用的结果"""
+
+    def __init__(self, queue_wait: float, saturated: bool = False):
+        self.queue_wait = queue_wait
+        # 获取名额时并发已接近上限；只有这样的调用成功才说明上限可以再放宽
+        self.saturated = saturated
+        self.started_at = time.monotonic()
+        self.latency: Optional[float] = None
+        self.overloaded = False
+
+    def record_status(self, status_code: int):
+        """记录上游响应状态码（429/5xx视为过载信号）"""
+        if self.latency is None:
+            self.latency = time.monotonic() - self.started_at
+        if status_code == 429 or status_code >= 500:
+            self.overloaded = True
+
+
+class UpstreamScheduler:
+    """上游调用调度器：AIMD自适应并发上限 + 按优先级排队"""
+
+    def __init__(self, name: str, initial_limit: int = 8, min_limit: int = 1, max_limit: int = 64,
+                 queue_timeout: float = 10.0, decrease_factor: float = 0.7, cooldown: float = 1.0):
+        self.name = name
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.queue_timeout = queue_timeout
+        self.decrease_factor = decrease_factor
+        # 两次乘性减小之间的最短间隔，避免同一波失败把上限压到底
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._last_decrease = 0.0
+        # 短期/长期延迟均值，短期明显高于长期时视为拥塞
+        self._latency_short: Optional[float] = None
+        self._latency_long: Optional[float] = None
+        self._queue_waits = deque(maxlen=1000)
+        self.completed = 0
+        self.overloads = 0
+        self.rejected = 0
+
+    @classmethod
+    def from_env(cls, name: str, prefix: str, **defaults) -> "UpstreamScheduler":
+        """从环境变量读取配置，如 DASHSCOPE_MAX_CONCURRENCY"""
+        return cls(
+            name,
+            initial_limit=int(os.getenv(f"{prefix}_INITIAL_CONCURRENCY", defaults.get("initial_limit", 8))),
+            max_limit=int(os.getenv(f"{prefix}_MAX_CONCURRENCY", defaults.get("max_limit", 64))),
+            queue_timeout=float(os.getenv(f"{prefix}_QUEUE_TIMEOUT", defaults.get("queue_timeout", 10.0)))
+        )
+
+    def _has_capacity(self) -> bool:
+        return self.in_flight < int(self.limit)
+
+    async def acquire(self, priority: int = PRIORITY_INTERACTIVE) -> UpstreamSlot:
+        """获取一个并发名额，名额不足时按优先级排队"""
+        started = time.monotonic()
+        if self._has_capacity() and not self._waiters:
+            self.in_flight += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            entry = (priority, next(self._sequence), future)
+            heapq.heappush(self._waiters, entry)
+            try:
+                # 名额由release直接转交，醒来时in_flight已计入
+                await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+            except asyncio.TimeoutError:
+                if future.done() and not future.cancelled():
+                    # 超时的同时拿到了名额，直接使用
+                    pass
+                else:
+                    future.cancel()
+                    self.rejected += 1
+                    raise UpstreamBusyError(f"{self.name} 排队超时")
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    self._release_slot()
+                else:
+                    future.cancel()
+                raise
+
+        queue_wait = time.monotonic() - started
+        self._queue_waits.append(queue_wait)
+        return UpstreamSlot(queue_wait, saturated=self.in_flight >= self.limit / 2)
+
+    def release(self, slot: UpstreamSlot, overloaded: bool = False, adjust: bool = True):
+        """归还名额，并根据本次调用的延迟和结果调整并发上限（adjust为False时只归还名额）"""
+        latency = slot.latency if slot.latency is not None else time.monotonic() - slot.started_at
+        self.completed += 1
+        if adjust:
+            if overloaded or slot.overloaded:
+                self.overloads += 1
+                self._decrease()
+            elif self._observe_latency(latency):
+                self._decrease()
+            elif slot.saturated:
+                # 加性增加：每轮约增加一个名额；并发远低于上限时上限不是瓶颈，不增加
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+        self._release_slot()
+
+    def _observe_latency(self, latency: float) -> bool:
+        """更新延迟均值，返回是否出现拥塞迹象"""
+        if self._latency_short is None:
+            self._latency_short = self._latency_long = latency
+            return False
+        self._latency_short += 0.3 * (latency - self._latency_short)
+        self._latency_long += 0.02 * (latency - self._latency_long)
+        return self._latency_short > self._latency_long * 2
+
+    def _decrease(self):
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+
+    def _release_slot(self):
+        self.in_flight -= 1
+        # 把空出的名额按优先级转交给排队者
+        while self._waiters and self._has_capacity():
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            self.in_flight += 1
+            future.set_result(None)
+
+    def slot(self, priority: int = PRIORITY_INTERACTIVE, deadline: Optional[float] = None) -> "_SlotContext":
+        """以上下文管理器方式占用名额：async with scheduler.slot() as slot
+
+        deadline为调用方截止时间（time.monotonic()时刻），用于区分因超时和因其他原因被取消的调用
+        """
+        return _SlotContext(self, priority, deadline)
+
+    def stats(self) -> Dict[str, Any]:
+        """调度器状态与排队等待统计"""
+        waits = list(self._queue_waits)
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "queued": sum(1 for _, _, future in self._waiters if not future.done()),
+            "completed": self.completed,
+            "overloads": self.overloads,
+            "rejected": self.rejected,
+            "queue_wait_p50": round(percentile(waits, 0.5), 4),
+            "queue_wait_p95": round(percentile(waits, 0.95), 4),
+            "queue_wait_max": round(max(waits), 4) if waits else 0.0
+        }
+
+
+class _SlotContext:
+    def __init__(self, scheduler: UpstreamScheduler, priority: int, deadline: Optional[float] = None):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.deadline = deadline
+        self.slot: Optional[UpstreamSlot] = None
+
+    async def __aenter__(self) -> UpstreamSlot:
+        self.slot = await self.scheduler.acquire(self.priority)
+        return self.slot
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is not None and issubclass(exc_type, asyncio.CancelledError):
+            # 外层wait_for到达截止时间时以取消的形式结束，视为超时；
+            # 其他取消（如客户端断开）与上游状况无关，只归还名额不调整上限（事件循环定时器允许略早触发）
+            if self.deadline is None or time.monotonic() < self.deadline - 0.01:
+                self.scheduler.release(self.slot, adjust=False)
+                return False
+            timed_out = True
+        else:
+            # 超时同样视为过载信号
+            timed_out = exc_type is not None and issubclass(exc_type, (asyncio.TimeoutError, httpx.TimeoutException))
+        self.scheduler.release(self.slot, overloaded=timed_out)
+        return False
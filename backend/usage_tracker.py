@@ -0,0 +1,183 @@
+import asyncio
+import json
+import os
+from contextvars import ContextVar
+from datetime import date
+from typing import Any, Dict, Optional, Tuple
+
+from database import DatabaseManager
+
+# 每千token单价（元），(输入, 输出)；可用MODEL_PRICES环境变量（JSON）覆盖
+DEFAULT_PRICES = {
+    "qwen-max": (0.02, 0.06),
+    "qwen-plus": (0.0008, 0.002),
+    "qwen-turbo": (0.0003, 0.0006),
+}
+
+# 当前请求的计费归属（用户、角色），随asyncio任务的上下文传递，
+# 后台任务（如对话摘要）创建时会继承发起请求的归属
+_account: ContextVar[Tuple[str, str]] = ContextVar("usage_account", default=("system", "unknown"))
+
+
+def set_usage_account(user_id: Optional[str] = None, character_id: Optional[str] = None):
+    """设置当前请求的计费归属，未传入的字段保持不变"""
+    current_user, current_character = _account.get()
+    _account.set((user_id or current_user, character_id or current_character))
+
+
+def get_usage_account() -> Tuple[str, str]:
+    return _account.get()
+
+
+class UsageTracker:
+    """按用户和角色统计token用量与费用：内存计数，定期批量写入SQLite"""
+
+    def __init__(self, db_manager: DatabaseManager, flush_interval: Optional[float] = None,
+                 daily_token_quota: Optional[int] = None, prices: Optional[Dict[str, Any]] = None):
+        self.db_manager = db_manager
+        self.flush_interval = flush_interval or float(os.getenv("USAGE_FLUSH_INTERVAL", "30"))
+        # 每个用户每天的token上限，0表示不限制
+        self.daily_token_quota = daily_token_quota if daily_token_quota is not None else int(
+            os.getenv("USAGE_DAILY_TOKEN_QUOTA", "0")
+        )
+        if prices is None and os.getenv("MODEL_PRICES"):
+            prices = json.loads(os.getenv("MODEL_PRICES"))
+        self.prices = prices if prices is not None else DEFAULT_PRICES
+        # 尚未写入数据库的增量：(user_id, character_id, model, day) -> 计数
+        self._pending: Dict[tuple, Dict[str, float]] = {}
+        # 用户当天累计token（含已写入部分），用于配额检查，不查数据库
+        self._daily_tokens: Dict[Tuple[str, str], int] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.calls = 0
+        self.flushes = 0
+
+    def cost(self, model: str, input_tokens: int, output_tokens: int) -> float:
+        """按单价估算一次调用的费用（元），未知模型按0计"""
+        input_price, output_price = self.prices.get(model, (0.0, 0.0))
+        return (input_tokens * input_price + output_tokens * output_price) / 1000
+
+    def record(self, model: str, usage: Optional[Dict[str, Any]], latency: Optional[float]):
+        """记录一次上游调用的用量，归属取自当前上下文"""
+        usage = usage or {}
+        input_tokens = int(usage.get("input_tokens", 0))
+        output_tokens = int(usage.get("output_tokens", 0))
+        user_id, character_id = get_usage_account()
+        day = date.today().isoformat()
+
+        counters = self._pending.setdefault((user_id, character_id, model, day), {
+            "calls": 0, "input_tokens": 0, "output_tokens": 0, "latency_total": 0.0, "cost": 0.0
+        })
+        counters["calls"] += 1
+        counters["input_tokens"] += input_tokens
+        counters["output_tokens"] += output_tokens
+        counters["latency_total"] += latency or 0.0
+        counters["cost"] += self.cost(model, input_tokens, output_tokens)
+
+        key = (user_id, day)
+        self._daily_tokens[key] = self._daily_tokens.get(key, 0) + input_tokens + output_tokens
+        self.calls += 1
+
+    def check_quota(self, user_id: str) -> Dict[str, Any]:
+        """检查用户当天的token配额（只读内存计数）"""
+        used = self._daily_tokens.get((user_id, date.today().isoformat()), 0)
+        allowed = not self.daily_token_quota or used < self.daily_token_quota
+        return {"allowed": allowed, "used": used, "limit": self.daily_token_quota}
+
+    def load_daily_totals(self):
+        """启动时从数据库加载当天已有的用量，保证重启后配额仍然有效"""
+        day = date.today().isoformat()
+        for user_id, tokens in self.db_manager.get_daily_token_totals(day).items():
+            key = (user_id, day)
+            self._daily_tokens[key] = self._daily_tokens.get(key, 0) + tokens
+
+    def flush(self) -> int:
+        """把内存中的增量在一个事务里写入数据库，返回写入的行数"""
+        if not self._pending:
+            return 0
+        pending, self._pending = self._pending, {}
+        rows = [
+            (user_id, character_id, model, day, int(c["calls"]), int(c["input_tokens"]),
+             int(c["output_tokens"]), c["latency_total"], c["cost"])
+            for (user_id, character_id, model, day), c in pending.items()
+        ]
+        try:
+            self.db_manager.save_token_usage(rows)
+        except Exception as e:
+            print(f"用量写入失败，下次重试: {e}")
+            # 写入失败时把增量合并回去，不丢计数
+            for key, counters in pending.items():
+                merged = self._pending.setdefault(key, dict.fromkeys(counters, 0))
+                for field, value in counters.items():
+                    merged[field] += value
+            return 0
+        self.flushes += 1
+        return len(rows)
+
+    def start(self):
+        """加载当天用量并启动定期写入任务"""
+        self.load_daily_totals()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """停止定期写入，并把剩余增量写入数据库"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.flush()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self.flush()
+
+    def usage(self, user_id: Optional[str] = None, character_id: Optional[str] = None) -> Dict[str, Any]:
+        """按用户或角色汇总用量（数据库中的记录加上尚未写入的增量），按模型分组"""
+        by_model: Dict[str, Dict[str, float]] = {}
+
+        def add(model: str, calls, input_tokens, output_tokens, latency_total, cost):
+            totals = by_model.setdefault(model, {
+                "calls": 0, "input_tokens": 0, "output_tokens": 0, "latency_total": 0.0, "cost": 0.0
+            })
+            totals["calls"] += calls
+            totals["input_tokens"] += input_tokens
+            totals["output_tokens"] += output_tokens
+            totals["latency_total"] += latency_total
+            totals["cost"] += cost
+
+        for row in self.db_manager.get_token_usage(user_id=user_id, character_id=character_id):
+            add(row["model"], row["calls"], row["input_tokens"], row["output_tokens"],
+                row["latency_total"], row["cost"])
+        for (row_user, row_character, model, _), c in self._pending.items():
+            if user_id and row_user != user_id or character_id and row_character != character_id:
+                continue
+            add(model, c["calls"], c["input_tokens"], c["output_tokens"], c["latency_total"], c["cost"])
+
+        models = {
+            model: {
+                "calls": int(t["calls"]),
+                "input_tokens": int(t["input_tokens"]),
+                "output_tokens": int(t["output_tokens"]),
+                "avg_latency": round(t["latency_total"] / t["calls"], 4) if t["calls"] else 0.0,
+                "cost": round(t["cost"], 6)
+            }
+            for model, t in by_model.items()
+        }
+        return {
+            "models": models,
+            "total_tokens": sum(m["input_tokens"] + m["output_tokens"] for m in models.values()),
+            "total_cost": round(sum(m["cost"] for m in models.values()), 6)
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        """计数器状态"""
+        return {
+            "calls": self.calls,
+            "pending_rows": len(self._pending),
+            "flushes": self.flushes,
+            "daily_token_quota": self.daily_token_quota
+        }
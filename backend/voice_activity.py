@@ -0,0 +1,273 @@
+import io
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import wave
+from typing import Any, BinaryIO, Dict, NamedTuple, Optional, Union
+
+try:
+    import numpy as np
+except ImportError:  # 未安装numpy时跳过静音裁剪，音频原样送去识别
+    np = None
+
+AudioInput = Union[bytes, memoryview, BinaryIO]
+
+# 需要先用ffmpeg解码成PCM才能分析的压缩格式（浏览器录音为webm）
+COMPRESSED_FORMATS = ("webm", "ogg", "mp3")
+
+
+class TrimResult(NamedTuple):
+    audio: AudioInput
+    audio_format: str
+    speech: bool
+    duration: float
+    trimmed_seconds: float
+    analyzed: bool
+
+
+class AudioSlice(io.RawIOBase):
+    """文件中一段字节区间的只读视图（可带一个前缀，如新的WAV头），裁剪结果不必复制到内存"""
+
+    def __init__(self, source: BinaryIO, start: int, length: int, prefix: bytes = b""):
+        super().__init__()
+        self.source = source
+        self.start = start
+        self.length = length
+        self.prefix = prefix
+        self._position = 0
+
+    def __len__(self) -> int:
+        return len(self.prefix) + self.length
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: len(self)}[whence]
+        self._position = max(0, min(len(self), base + offset))
+        return self._position
+
+    def read(self, size: int = -1) -> bytes:
+        remaining = len(self) - self._position
+        size = remaining if size is None or size < 0 else min(size, remaining)
+        chunks = []
+        if size and self._position < len(self.prefix):
+            head = self.prefix[self._position:self._position + size]
+            chunks.append(head)
+            self._position += len(head)
+            size -= len(head)
+        if size:
+            self.source.seek(self.start + self._position - len(self.prefix))
+            data = self.source.read(size)
+            chunks.append(data)
+            self._position += len(data)
+        return b"".join(chunks)
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class VoiceActivityDetector:
+    """基于短时能量和过零率的语音活动检测，裁掉录音首尾的静音（仅CPU，分块读取、按帧向量化计算）"""
+
+    def __init__(self, frame_ms: int = 30, padding_ms: int = 200, min_speech_ms: int = 150,
+                 energy_ratio: float = 3.0, min_energy: float = 300.0, zcr_threshold: float = 0.25,
+                 pcm_sample_rate: Optional[int] = None, chunk_frames: int = 1000):
+        self.frame_ms = frame_ms
+        # 语音段前后保留的余量，避免切掉起止的轻音
+        self.padding_ms = padding_ms
+        self.min_speech_ms = min_speech_ms
+        # 能量超过噪声底的倍数（且不低于绝对下限，16位采样幅度）视为语音
+        self.energy_ratio = energy_ratio
+        self.min_energy = min_energy
+        # 能量稍弱但过零率高的帧（清辅音）同样视为语音
+        self.zcr_threshold = zcr_threshold
+        # 原始PCM没有头信息，按16位单声道和该采样率解析（ffmpeg也解码为这个格式）
+        self.pcm_sample_rate = pcm_sample_rate or int(os.getenv("VAD_PCM_SAMPLE_RATE", "16000"))
+        # 每次读入多少个分析帧（默认约30秒），内存占用与录音长度无关
+        self.chunk_frames = chunk_frames
+        self.enabled = np is not None and os.getenv("VAD_ENABLED", "1") != "0"
+        # 压缩格式需要ffmpeg解码，未安装时原样送去识别
+        self.ffmpeg = os.getenv("VAD_FFMPEG") or shutil.which("ffmpeg")
+        self.decode_timeout = float(os.getenv("VAD_DECODE_TIMEOUT", "30"))
+        self.clips = 0
+        self.rejected = 0
+        self.skipped = 0
+        self.decoded = 0
+        self.decode_errors = 0
+        self.input_seconds = 0.0
+        self.trimmed_seconds = 0.0
+
+    def trim(self, audio: AudioInput, audio_format: str) -> TrimResult:
+        """裁掉首尾静音，返回原音频或其裁剪后的文件视图；无法解码的格式原样返回（analyzed为False）
+
+        会读文件和调用ffmpeg，在事件循环中应放到线程里执行
+        """
+        if not self.enabled or (audio_format not in ("wav", "pcm") and
+                                not (audio_format in COMPRESSED_FORMATS and self.ffmpeg)):
+            return self._skip(audio, audio_format)
+
+        source = io.BytesIO(audio) if isinstance(audio, (bytes, bytearray, memoryview)) else audio
+        source.seek(0)
+        try:
+            if audio_format in COMPRESSED_FORMATS:
+                source = self._decode(source)
+                data_start, channels, sample_width, sample_rate = 0, 1, 2, self.pcm_sample_rate
+            elif audio_format == "wav":
+                with wave.open(source, "rb") as wav:
+                    channels, sample_width, sample_rate = wav.getnchannels(), wav.getsampwidth(), wav.getframerate()
+                    # 读完头部后文件位置正好在data块的起点
+                    data_start = source.tell()
+                    data_length = wav.getnframes() * channels * sample_width
+            else:
+                data_start, channels, sample_width, sample_rate = 0, 1, 2, self.pcm_sample_rate
+            if audio_format != "wav":
+                data_length = source.seek(0, io.SEEK_END) - data_start
+        except (wave.Error, EOFError, OSError, subprocess.SubprocessError) as e:
+            print(f"音频解析失败，跳过静音裁剪: {e}")
+            if audio_format in COMPRESSED_FORMATS:
+                self.decode_errors += 1
+            return self._skip(audio, audio_format)
+
+        if sample_width != 2:
+            # 只分析16位采样，其余情况原样送去识别
+            self._release(source, audio)
+            return self._skip(audio, audio_format)
+
+        bytes_per_frame = channels * sample_width
+        sample_count = data_length // bytes_per_frame
+        duration = sample_count / sample_rate
+        start, end = self._speech_bounds(source, data_start, sample_count, channels, sample_rate)
+
+        self.clips += 1
+        self.input_seconds += duration
+        if start is None:
+            self.rejected += 1
+            self._release(source, audio)
+            return TrimResult(b"", audio_format, False, duration, duration, True)
+
+        trimmed = duration - (end - start) / sample_rate
+        if not trimmed:
+            self._release(source, audio)
+            return TrimResult(self._rewind(audio), audio_format, True, duration, 0.0, True)
+        self.trimmed_seconds += trimmed
+        length = (end - start) * bytes_per_frame
+        # 解码出的PCM加WAV头送去识别，服务端不必再猜测采样率
+        output_format = "pcm" if audio_format == "pcm" else "wav"
+        prefix = b"" if output_format == "pcm" else self._wav_header(length, channels, sample_width, sample_rate)
+        return TrimResult(AudioSlice(source, data_start + start * bytes_per_frame, length, prefix),
+                          output_format, True, duration, trimmed, True)
+
+    def _skip(self, audio: AudioInput, audio_format: str) -> TrimResult:
+        self.skipped += 1
+        return TrimResult(self._rewind(audio), audio_format, True, 0.0, 0.0, False)
+
+    @staticmethod
+    def _release(source: BinaryIO, audio: AudioInput):
+        """不返回裁剪视图时关闭分析用的副本（解码出的临时文件），调用方传入的文件由调用方关闭"""
+        if source is not audio:
+            source.close()
+
+    @staticmethod
+    def _rewind(audio: AudioInput) -> AudioInput:
+        if hasattr(audio, "seek"):
+            audio.seek(0)
+        return audio
+
+    def _decode(self, source: BinaryIO) -> BinaryIO:
+        """用ffmpeg把压缩音频解码为16位单声道PCM，写入临时文件（随返回的文件对象关闭而删除）"""
+        output = tempfile.TemporaryFile()
+        command = [self.ffmpeg, "-v", "error", "-i", "pipe:0",
+                   "-f", "s16le", "-ac", "1", "-ar", str(self.pcm_sample_rate), "pipe:1"]
+        try:
+            if isinstance(source, io.BytesIO):
+                subprocess.run(command, input=source.getbuffer(), stdout=output, stderr=subprocess.PIPE,
+                               timeout=self.decode_timeout, check=True)
+            else:
+                # 磁盘上的上传文件直接作为ffmpeg的标准输入，不读入内存
+                source.seek(0)
+                subprocess.run(command, stdin=source, stdout=output, stderr=subprocess.PIPE,
+                               timeout=self.decode_timeout, check=True)
+        except subprocess.CalledProcessError as e:
+            output.close()
+            raise subprocess.SubprocessError(f"ffmpeg解码失败: {e.stderr.decode('utf-8', 'replace').strip()}")
+        except Exception:
+            output.close()
+            raise
+        self.decoded += 1
+        return output
+
+    def _speech_bounds(self, source: BinaryIO, data_start: int, sample_count: int, channels: int,
+                       sample_rate: int):
+        """分块计算每帧的能量和过零率，返回语音段的起止采样点（含余量），没有足够的语音时返回 (None, None)"""
+        frame_length = max(1, sample_rate * self.frame_ms // 1000)
+        frame_count = sample_count // frame_length
+        if frame_count == 0:
+            return None, None
+
+        energies, zcrs = [], []
+        chunk_bytes = self.chunk_frames * frame_length * channels * 2
+        source.seek(data_start)
+        for done in range(0, frame_count, self.chunk_frames):
+            count = min(self.chunk_frames, frame_count - done)
+            raw = source.read(min(chunk_bytes, count * frame_length * channels * 2))
+            samples = np.frombuffer(raw, dtype="<i2", count=len(raw) // (channels * 2) * channels)
+            if channels > 1:
+                samples = samples.reshape(-1, channels).mean(axis=1)
+            count = len(samples) // frame_length
+            if count == 0:
+                break
+            frames = samples[:count * frame_length].reshape(count, frame_length).astype(np.float32)
+            energies.append(np.sqrt(np.mean(frames ** 2, axis=1)))
+            zcrs.append(np.mean(np.abs(np.diff(np.signbit(frames), axis=1)), axis=1))
+        if not energies:
+            return None, None
+        energy = np.concatenate(energies)
+        zcr = np.concatenate(zcrs)
+        frame_count = len(energy)
+
+        noise_floor = np.percentile(energy, 10)
+        threshold = max(noise_floor * self.energy_ratio, self.min_energy)
+        speech = (energy > threshold) | ((energy > threshold / 2) & (zcr > self.zcr_threshold))
+
+        speech_frames = np.flatnonzero(speech)
+        if len(speech_frames) * self.frame_ms < self.min_speech_ms:
+            return None, None
+
+        padding = self.padding_ms // self.frame_ms
+        first = max(0, speech_frames[0] - padding)
+        last = min(frame_count, speech_frames[-1] + 1 + padding)
+        end = sample_count if last == frame_count else last * frame_length
+        return int(first * frame_length), int(end)
+
+    @staticmethod
+    def _wav_header(data_length: int, channels: int, sample_width: int, sample_rate: int) -> bytes:
+        """标准44字节PCM WAV头"""
+        byte_rate = sample_rate * channels * sample_width
+        return struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", 36 + data_length, b"WAVE", b"fmt ", 16, 1,
+                           channels, sample_rate, byte_rate, channels * sample_width, sample_width * 8,
+                           b"data", data_length)
+
+    def stats(self) -> Dict[str, Any]:
+        """静音裁剪统计"""
+        return {
+            "enabled": self.enabled,
+            "ffmpeg": bool(self.ffmpeg),
+            "clips": self.clips,
+            "rejected_silent": self.rejected,
+            "skipped": self.skipped,
+            "decoded": self.decoded,
+            "decode_errors": self.decode_errors,
+            "input_seconds": round(self.input_seconds, 2),
+            "trimmed_seconds": round(self.trimmed_seconds, 2)
+        }
@@ -1,13 +1,28 @@
-import requests
 import json
 import base64
 import io
 import os
-from typing import Optional
+from typing import Optional, Union, BinaryIO
 import asyncio
 
+import httpx
+
+from asr_cache import AsrCache
+from audio_cache import AudioCache
+from blob_store import BlobStore
+from voice_activity import VoiceActivityDetector
+from http_client import get_http_client
+from single_flight import SingleFlight
+from upstream_scheduler import UpstreamScheduler
+
+
+class AsrUnavailableError(RuntimeError):
+    """七牛云无法访问上传的音频（未配置BLOB_PUBLIC_BASE_URL），不能进行识别"""
+
+
 class VoiceService:
-    def __init__(self):
+    def __init__(self, http_client: Optional[httpx.AsyncClient] = None, blob_store: Optional[BlobStore] = None,
+                 db_manager=None):
         # 使用七牛云的语音服务（从环境变量读取配置）
         self.base_url = os.getenv("QINIU_BASE_URL", "https://openai.qiniu.com/v1")
         self.api_key = os.getenv("QINIU_TTS_KEY", "")
@@ -19,6 +34,43 @@ class VoiceService:
         
         # 缓存音色类型
         self._voice_type = None
+        
+        # 上游并发调度：自适应并发上限，过载时排队而不是一起失败
+        self.scheduler = UpstreamScheduler.from_env("qiniu", "QINIU")
+        
+        # 未显式传入时使用进程内共享的连接池；各接口的超时时间（秒）
+        self._http_client = http_client
+        self.list_timeout = float(os.getenv("QINIU_LIST_TIMEOUT", "10"))
+        self.asr_timeout = float(os.getenv("QINIU_ASR_TIMEOUT", "30"))
+        self.tts_timeout = float(os.getenv("QINIU_TTS_TIMEOUT", "60"))
+        
+        # 合成结果的磁盘缓存，相同文本和参数的重复播放只需读一次磁盘；预算为0时关闭
+        cache_bytes = int(os.getenv("TTS_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+        self.tts_cache = AudioCache(os.getenv("TTS_CACHE_DIR", "tts_cache"), cache_bytes) if cache_bytes > 0 else None
+        
+        # 七牛云ASR只接受音频URL：用户音频写入blob存储后以签名URL提供给ASR
+        self.blob_store = blob_store
+        
+        # 识别前的静音检测与裁剪
+        self.vad = VoiceActivityDetector()
+        
+        # 识别结果缓存：相同的录音（常见短句、客户端重试）不再请求ASR；容量为0时关闭
+        self.asr_model = os.getenv("QINIU_ASR_MODEL", "whisper-1")
+        asr_entries = int(os.getenv("ASR_CACHE_SIZE", "2048"))
+        persist = db_manager if os.getenv("ASR_CACHE_PERSIST", "0") == "1" else None
+        self.asr_cache = AsrCache(asr_entries, persist) if asr_entries > 0 else None
+        # 相同录音的并发识别只发出一次请求
+        self.asr_flight = SingleFlight()
+    
+    @property
+    def tts_configured(self) -> bool:
+        """是否配置了有效的TTS密钥；否则为测试模式，合成只返回模拟音频"""
+        return len(self.api_key) >= 20
+    
+    @property
+    def http_client(self) -> httpx.AsyncClient:
+        """七牛云请求使用的异步HTTP客户端（等待响应时不阻塞事件循环，可被取消）"""
+        return self._http_client or get_http_client()
     
     async def _get_voice_type(self) -> str:
         """获取可用的音色类型（测试模式：无API密钥限制）"""
@@ -32,7 +84,13 @@ class VoiceService:
                 self._voice_type = "qiniu_zh_female_tmjxxy"  # 使用七牛云的有效音色
                 return self._voice_type
                 
-            response = requests.get(f"{self.base_url}/voice/list", headers=self.headers, timeout=30)
+            async with self.scheduler.slot() as slot:
+                response = await self.http_client.get(
+                    f"{self.base_url}/voice/list",
+                    headers=self.headers,
+                    timeout=self.list_timeout
+                )
+                slot.record_status(response.status_code)
             response.raise_for_status()
             voices = response.json()
             
@@ -57,13 +115,28 @@ class VoiceService:
         return self._voice_type
     
 
-    async def speech_to_text(self, audio_data: bytes) -> str:
-        """语音转文字 - 使用七牛云ASR（测试模式：无API密钥限制）"""
+    async def speech_to_text(self, audio_data: Union[bytes, memoryview, BinaryIO], audio_format: str = "mp3",
+                             fallback: bool = True) -> str:
+        """语音转文字 - 使用七牛云ASR（测试模式：无API密钥限制）
+        
+        audio_data可以是字节、memoryview或已定位到开头的文件对象（大上传不必整体读入内存）；
+        fallback为False时识别出错直接抛出异常，不返回模拟结果
+        """
+        # 裁掉首尾静音，识别耗时只与语音长度有关；没有语音的录音直接返回空文本
+        # （分块读文件、可能调用ffmpeg解码，放到线程中执行，不阻塞事件循环）
+        trim = await asyncio.to_thread(self.vad.trim, audio_data, audio_format)
+        if not trim.speech:
+            print(f"未检测到语音（录音{trim.duration:.1f}秒），跳过识别")
+            return ""
+        if trim.trimmed_seconds:
+            print(f"静音裁剪：{trim.duration:.1f}秒 -> {trim.duration - trim.trimmed_seconds:.1f}秒")
+        audio_data, audio_format = trim.audio, trim.audio_format
+        
         try:
             # 使用七牛云语音识别
             if self.api_key:
                 print("使用七牛云进行语音识别")
-                return await self.speech_to_text_qiniu(audio_data)
+                return await self.speech_to_text_qiniu(audio_data, audio_format, fallback)
             
             # 测试模式：如果没有API密钥，返回模拟识别结果
             print("测试模式：ASR配置缺失，返回模拟识别结果")
@@ -83,8 +156,13 @@ class VoiceService:
             ]
             return "你好" if random.random() < 0.3 else random.choice(mock_texts)
             
+        except AsrUnavailableError:
+            # 配置错误不能用模拟结果掩盖，否则会把随机文本当作用户说的话
+            raise
         except Exception as e:
             print(f"语音识别出错: {str(e)}")
+            if not fallback:
+                raise
             # 测试模式：异常时返回模拟结果
             import random
             mock_texts = [
@@ -102,71 +180,46 @@ class VoiceService:
             ]
             return "你好" if random.random() < 0.3 else random.choice(mock_texts)
 
-    async def speech_to_text_qiniu(self, audio_data: bytes) -> str:
-        """语音转文字 - 使用七牛云ASR"""
+    async def speech_to_text_qiniu(self, audio_data: Union[bytes, memoryview, BinaryIO], audio_format: str = "mp3",
+                                   fallback: bool = True) -> str:
+        """语音转文字 - 使用七牛云ASR，识别结果按音频内容缓存"""
+        if self.blob_store and not self.blob_store.public_base_url:
+            # 相对URL七牛云必然无法下载，不发出注定失败的请求
+            raise AsrUnavailableError("未配置BLOB_PUBLIC_BASE_URL，七牛云ASR无法访问上传的音频")
+        if not self.asr_cache:
+            return await self._recognize_qiniu(audio_data, audio_format, fallback=fallback)
+        
+        cache_key = AsrCache.make_key(audio_data, self.asr_model)
+        text = self.asr_cache.get(cache_key)
+        if text is not None:
+            print("命中识别结果缓存，跳过七牛云ASR")
+            return text
+        return await self.asr_flight.do(
+            cache_key, lambda: self._recognize_qiniu(audio_data, audio_format, cache_key, fallback)
+        )
+    
+    async def _recognize_qiniu(self, audio_data: Union[bytes, memoryview, BinaryIO], audio_format: str,
+                               cache_key: Optional[str] = None, fallback: bool = True) -> str:
+        """调用七牛云ASR；识别成功且传入cache_key时写入缓存（模拟结果不缓存）"""
         try:
             # 七牛云ASR需要音频文件的URL，而不是直接的数据
-            # 这里我们使用一个测试音频URL
-            test_audio_url = "http://idh.qnaigc.com/voicetest.mp3"
-            
-            # 使用七牛云ASR API格式（使用whisper模型）
-            payload = {
-                "model": "whisper-1",
-                "audio": {
-                    "format": "mp3",
-                    "url": test_audio_url
-                }
-            }
-            
-            # 使用七牛云ASR API端点
-            asr_url = f"{self.base_url}/voice/asr"
-            
-            response = requests.post(
-                asr_url,
-                headers=self.headers,
-                json=payload,
-                timeout=30
-            )
-            
-            print(f"七牛云ASR响应状态: {response.status_code}")
-            print(f"七牛云ASR响应内容: {response.text}")
-            
-            if response.status_code == 200:
-                result = response.json()
-                # 根据七牛云API响应格式解析结果
-                if "data" in result:
-                    text = result["data"].get("result", {}).get("text", "")
-                elif "text" in result:
-                    text = result["text"]
-                elif "result" in result:
-                    text = result["result"]
-                else:
-                    text = str(result)
-                
-                return text if text else "未能识别到语音内容"
+            if self.blob_store:
+                audio_url = self.blob_store.url(self.blob_store.put(audio_data, audio_format))
             else:
-                print(f"七牛云ASR API错误: {response.status_code} - {response.text}")
-                # 测试模式：API错误时返回模拟结果而不是错误信息
-                import random
-                mock_texts = [
-                    "你好",
-                    "你好，我想和你聊天",
-                    "今天天气怎么样？",
-                    "你能帮我解答一个问题吗？",
-                    "请告诉我一个有趣的故事",
-                    "你觉得人工智能的未来会怎样？",
-                    "我想学习一些新知识",
-                    "你能推荐一些好书吗？",
-                    "最近有什么有趣的事情吗？",
-                    "我想了解你的想法",
-                    "我们可以聊聊哲学吗？"
-                ]
-                # 优先返回"你好"作为最常见的语音识别结果
-                return "你好" if random.random() < 0.3 else random.choice(mock_texts)
+                # 未配置blob存储时使用测试音频URL
+                audio_format = "mp3"
+                audio_url = "http://idh.qnaigc.com/voicetest.mp3"
+            
+            text = await self.recognize_url(audio_url, audio_format)
+            if text and cache_key:
+                self.asr_cache.set(cache_key, self.asr_model, text)
+            return text if text or not fallback else "未能识别到语音内容"
                 
         except Exception as e:
             print(f"七牛云语音识别出错: {str(e)}")
-            # 测试模式：异常时返回模拟结果
+            if not fallback:
+                raise
+            # 测试模式：API错误或异常时返回模拟结果
             import random
             mock_texts = [
                 "你好",
@@ -184,12 +237,56 @@ class VoiceService:
             # 优先返回"你好"作为最常见的语音识别结果
             return "你好" if random.random() < 0.3 else random.choice(mock_texts)
     
-    async def text_to_speech(self, text: str, voice_type: str = None) -> bytes:
-        """文字转语音 - 使用七牛云TTS（测试模式：无API密钥限制）"""
+    async def recognize_url(self, audio_url: str, audio_format: str = "mp3") -> str:
+        """用七牛云ASR识别可公网访问的音频URL，返回识别文本；上游出错时抛出异常"""
+        # 使用七牛云ASR API格式（使用whisper模型）
+        payload = {
+            "model": self.asr_model,
+            "audio": {
+                "format": audio_format,
+                "url": audio_url
+            }
+        }
+        
+        # 使用七牛云ASR API端点
+        asr_url = f"{self.base_url}/voice/asr"
+        
+        async with self.scheduler.slot() as slot:
+            response = await self.http_client.post(
+                asr_url,
+                headers=self.headers,
+                json=payload,
+                timeout=self.asr_timeout
+            )
+            slot.record_status(response.status_code)
+        
+        print(f"七牛云ASR响应状态: {response.status_code}")
+        print(f"七牛云ASR响应内容: {response.text}")
+        
+        if response.status_code != 200:
+            raise RuntimeError(f"七牛云ASR API错误: {response.status_code} - {response.text}")
+        
+        result = response.json()
+        # 根据七牛云API响应格式解析结果
+        if "data" in result:
+            return result["data"].get("result", {}).get("text", "")
+        elif "text" in result:
+            return result["text"]
+        elif "result" in result:
+            return result["result"]
+        return str(result)
+    
+    async def text_to_speech(self, text: str, voice_type: str = None, fallback: bool = True) -> bytes:
+        """文字转语音 - 使用七牛云TTS（测试模式：无API密钥限制）
+        
+        fallback为False时缺少有效密钥或上游出错直接抛出异常，不返回模拟音频（批量预生成时避免把模拟音频当作结果保存）
+        """
         import base64  # 在函数开始就导入base64模块
         try:
             # 测试模式：如果没有API密钥或密钥无效，返回模拟音频数据
-            if not self.api_key or len(self.api_key) < 20:
+            if not self.tts_configured:
+                if not fallback:
+                    raise RuntimeError("TTS配置缺失或密钥无效（QINIU_TTS_KEY）")
                 print("测试模式：TTS配置缺失或密钥无效，返回模拟音频数据")
                 # 使用有效的静音MP3数据
                 mock_mp3_base64 = "//uQAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA="
@@ -212,19 +309,32 @@ class VoiceService:
                 }
             }
             
-            response = requests.post(
-                f"{self.base_url}/voice/tts",
-                headers=self.headers,
-                json=payload,
-                timeout=60
-            )
+            cache_key = AudioCache.make_key(text=text, language=payload["request"]["language"], **payload["audio"])
+            if self.tts_cache:
+                cached = self.tts_cache.get(cache_key)
+                if cached:
+                    return cached
+            
+            async with self.scheduler.slot() as slot:
+                response = await self.http_client.post(
+                    f"{self.base_url}/voice/tts",
+                    headers=self.headers,
+                    json=payload,
+                    timeout=self.tts_timeout
+                )
+                slot.record_status(response.status_code)
             
             if response.status_code == 200:
                 result = response.json()
                 audio_b64 = result.get("data")
                 if audio_b64:
-                    return base64.b64decode(audio_b64)
+                    audio = base64.b64decode(audio_b64)
+                    if self.tts_cache:
+                        self.tts_cache.set(cache_key, audio)
+                    return audio
                 else:
+                    if not fallback:
+                        raise RuntimeError("TTS API未返回音频数据")
                     # 测试模式：API返回无数据时返回模拟音频
                     print("测试模式：API返回无音频数据，返回模拟音频")
                     return b'\xff\xfb\x90\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
@@ -244,25 +354,29 @@ class VoiceService:
                         pass
                 
                 print(f"TTS API错误: {response.status_code} - {response.text}")
+                if not fallback:
+                    raise RuntimeError(f"TTS API错误: {response.status_code}")
                 # 测试模式：API错误时返回模拟音频而不是抛出异常
                 print("测试模式：TTS API错误，返回模拟音频")
                 return b'\xff\xfb\x90\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
                 
         except Exception as e:
             print(f"文字转语音出错: {str(e)}")
+            if not fallback:
+                raise
             # 测试模式：异常时返回模拟音频而不是抛出异常
             print("测试模式：TTS异常，返回模拟音频")
             return b'\xff\xfb\x90\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
     
-    async def process_voice_chat(self, audio_data: bytes, character_name: str = "助手") -> dict:
+    async def process_voice_chat(self, audio_data: bytes, character_name: str = "助手", audio_format: str = "mp3") -> dict:
         """处理语音聊天 - 包含ASR和TTS的完整流程"""
         try:
             # 1. 语音转文字
-            user_text = await self.speech_to_text(audio_data)
+            user_text = await self.speech_to_text(audio_data, audio_format)
             if not user_text or "出错" in user_text:
                 return {
                     "success": False,
-                    "error": user_text,
+                    "error": user_text or "未检测到语音",
                     "user_text": "",
                     "response_text": "",
                     "response_audio": None
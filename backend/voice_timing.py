@@ -0,0 +1,102 @@
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+from upstream_scheduler import percentile
+
+# 耗时直方图的桶上限（秒）
+HISTOGRAM_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0)
+
+
+class StageHistogram:
+    """单个阶段的耗时分布：固定桶计数 + 最近样本的分位数"""
+
+    def __init__(self, buckets=HISTOGRAM_BUCKETS, window: int = 500):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self._recent = deque(maxlen=window)
+
+    def observe(self, seconds: float):
+        index = next((i for i, bound in enumerate(self.buckets) if seconds <= bound), len(self.buckets))
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        self._recent.append(seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        # 桶计数为累计值（小于等于该上限的样本数）
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip([str(b) for b in self.buckets] + ["+Inf"], self.counts):
+            cumulative += count
+            buckets[bound] = cumulative
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count, 4) if self.count else 0.0,
+            "p50": round(percentile(self._recent, 0.5), 4),
+            "p95": round(percentile(self._recent, 0.95), 4),
+            "p99": round(percentile(self._recent, 0.99), 4),
+            "buckets": buckets
+        }
+
+
+class StageTimer:
+    """一次语音请求的分阶段计时；同名阶段可出现多次（如每句的语音合成）"""
+
+    def __init__(self, metrics: Optional["VoiceTimings"] = None, debug: bool = False):
+        self.metrics = metrics
+        self.debug = debug
+        self.started = time.monotonic()
+        self.stages: Dict[str, List[float]] = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """统计with块内的耗时"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, time.monotonic() - start)
+
+    def record(self, name: str, seconds: float):
+        self.stages.setdefault(name, []).append(seconds)
+        if self.metrics is not None:
+            self.metrics.observe(name, seconds)
+
+    def timings(self) -> Dict[str, Any]:
+        """各阶段耗时（毫秒），出现多次的阶段返回列表"""
+        return {
+            name: round(values[0] * 1000, 1) if len(values) == 1 else [round(v * 1000, 1) for v in values]
+            for name, values in self.stages.items()
+        }
+
+    def finish(self) -> Optional[Dict[str, Any]]:
+        """记录总耗时；调试模式下返回各阶段耗时供回传客户端，否则返回None"""
+        self.record("total", time.monotonic() - self.started)
+        return self.timings() if self.debug else None
+
+
+class VoiceTimings:
+    """语音链路各阶段（识别、生成、合成、编码、发送）的耗时直方图"""
+
+    def __init__(self):
+        self.histograms: Dict[str, StageHistogram] = {}
+        # 开启后所有语音回复都携带timings字段，否则只在请求带debug标志时携带
+        self.debug_default = os.getenv("VOICE_TIMINGS_DEBUG", "0") == "1"
+
+    def timer(self, debug: bool = False) -> StageTimer:
+        return StageTimer(self, debug or self.debug_default)
+
+    def observe(self, stage: str, seconds: float):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = StageHistogram()
+        histogram.observe(seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        """各阶段耗时统计（秒）"""
+        return {stage: histogram.stats() for stage, histogram in self.histograms.items()}
@@ -1,80 +1,205 @@
-import os, base64, requests
-
-BASE = os.getenv("QINIU_BASE_URL", "https://openai.qiniu.com/v1")
-API_KEY = os.getenv("QINIU_TTS_KEY", "")  # 请在系统环境变量里设置 QINIU_TTS_KEY=sk-xxxx
-HEADERS = {
-    "Content-Type": "application/json",
-    "Authorization": f"Bearer {API_KEY}" if API_KEY else ""
-}
-
-def pick_voice():
-    # 获取音色列表，挑一个中文女声（你也可以打印全部列表自己选）
-    r = requests.get(f"{BASE}/voice/list", headers=HEADERS, timeout=30)
-    r.raise_for_status()
-    voices = r.json()
-    # 简单策略：优先包含 "zh" 的
-    for v in voices:
-        if "zh" in v.get("voice_type", ""):
-            return v["voice_type"]
-    # 兜底用第一个
-    return voices[0]["voice_type"] if voices else None
-
-def tts(text, voice_type, encoding="mp3", speed_ratio=1.0, outfile="tts_out.mp3"):
-    # 测试模式：如果没有API密钥，生成模拟音频
-    if not API_KEY:
-        print("测试模式：TTS配置缺失，生成模拟音频")
-        with open(outfile, "wb") as f:
-            f.write(b'\xff\xfb\x90\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00')
-        print(f"已保存音频：{outfile}，时长(毫秒)：1000")
-        return
-    
-    payload = {
-        "audio": {
-            "voice_type": voice_type,
-            "encoding": encoding,
-            "speed_ratio": speed_ratio
-        },
-        "request": {
-            "text": text
-        }
-    }
-    r = requests.post(f"{BASE}/voice/tts", headers=HEADERS, json=payload, timeout=60)
-    # 不直接 raise，先看返回体里有没有错误信息
-    if r.status_code >= 400:
-        print("HTTP", r.status_code, r.text[:500])
-        # 测试模式：API错误时生成模拟音频而不是抛出异常
-        print("测试模式：TTS API错误，生成模拟音频")
-        with open(outfile, "wb") as f:
-            f.write(b'\xff\xfb\x90\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00')
-        print(f"已保存音频：{outfile}，时长(毫秒)：1000")
-        return
-    # 文档说明：返回 JSON，data 字段是 base64 音频。:contentReference[oaicite:2]{index=2}
-    j = r.json()
-    audio_b64 = j.get("data")
-    if not audio_b64:
-        # 测试模式：无音频数据时生成模拟音频
-        print("测试模式：响应不含音频数据，生成模拟音频")
-        with open(outfile, "wb") as f:
-            f.write(b'\xff\xfb\x90\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00')
-        print(f"已保存音频：{outfile}，时长(毫秒)：1000")
-        return
-    with open(outfile, "wb") as f:
-        f.write(base64.b64decode(audio_b64))
-    print(f"已保存音频：{outfile}，时长(毫秒)：{j.get('addition',{}).get('duration')}")
+#!/usr/bin/env python3
+"""
+七牛云TTS批量合成工具：并发把大量文本（角色介绍、常见问题回答等）预先合成为音频。
+
+Usage examples:
+  - python tts.py lines.jsonl --out-dir tts_out
+  - python tts.py faq.csv --concurrency 8 --rate 5 --retries 2
+
+输入格式（按扩展名识别，也可用 --format 指定）：
+  - JSONL：每行一个对象 {"id": "intro_einstein", "text": "...", "voice": "qiniu_zh_female_tmjxxy"}
+  - CSV：表头包含 id、text 列，voice 列可选
+  voice 为空时使用 --voice，仍为空则与后端一样自动挑选中文音色。
+
+输出：
+  - <out-dir>/<id>-<hash>.mp3，id中的不安全字符替换为下划线，并附加原始id的短摘要，
+    不同的id（如 a/b 与 a_b）不会写到同一个文件；先写临时文件再原子替换，中断不会留下半个文件
+  - <out-dir>/manifest.jsonl，每合成完一条追加一行；中断后重新运行同一命令即可续跑，
+    已记录且输出文件存在、文本和音色未变的条目会跳过
+
+与后端共用 VoiceService：同一个连接池、自适应并发调度（QINIU_MAX_CONCURRENCY 等）和 TTS 磁盘缓存
+（默认 backend/tts_cache，可用 TTS_CACHE_DIR 覆盖）。缺少有效的 QINIU_TTS_KEY 时直接退出，
+不会把测试模式的模拟音频写入输出和清单。
+"""
+
+import argparse
+import asyncio
+import csv
+import hashlib
+import json
+import os
+import re
+import sys
+import tempfile
+from typing import Any, Dict, Iterator, Optional
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend")
+sys.path.insert(0, BACKEND_DIR)
+# 与后端服务使用同一个缓存目录（后端以backend为工作目录运行）
+os.environ.setdefault("TTS_CACHE_DIR", os.path.join(BACKEND_DIR, "tts_cache"))
+
+from batch_runner import BatchStats, run_batch
+from http_client import close_http_client
+from voice_service import VoiceService
+
+MANIFEST_NAME = "manifest.jsonl"
+# 输出文件名只保留安全字符，防止id中的路径分隔符写到输出目录之外
+_UNSAFE_CHARS = re.compile(r"[^0-9A-Za-z_.\-\u4e00-\u9fff]")
+
+
+def read_items(path: str, input_format: str) -> Iterator[Dict[str, Any]]:
+    """逐条读取输入，缺少id或text的行打印提示后跳过"""
+    if input_format == "auto":
+        input_format = "csv" if path.lower().endswith(".csv") else "jsonl"
+
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        if input_format == "csv":
+            rows = enumerate(csv.DictReader(f), start=2)
+        else:
+            rows = ((number, line) for number, line in enumerate(f, start=1) if line.strip())
+
+        for number, row in rows:
+            if isinstance(row, str):
+                try:
+                    row = json.loads(row)
+                except json.JSONDecodeError as e:
+                    print(f"第{number}行不是合法的JSON，已跳过: {e}")
+                    continue
+            item_id = str(row.get("id") or "").strip()
+            text = (row.get("text") or "").strip()
+            if not item_id or not text:
+                print(f"第{number}行缺少id或text，已跳过")
+                continue
+            yield {"id": item_id, "text": text, "voice": (row.get("voice") or "").strip() or None}
+
+
+def output_name(item_id: str) -> str:
+    """输出文件名：替换不安全字符后的id加原始id的短摘要，替换后相同的id不会互相覆盖"""
+    safe = _UNSAFE_CHARS.sub('_', item_id).lstrip('.') or '_'
+    return f"{safe}-{hashlib.sha256(item_id.encode('utf-8')).hexdigest()[:8]}.mp3"
+
+
+def item_digest(text: str, voice: Optional[str]) -> str:
+    """文本和音色的摘要，用于续跑时判断条目内容是否变化"""
+    return hashlib.sha256(f"{voice or ''}\0{text}".encode("utf-8")).hexdigest()[:16]
+
+
+def load_manifest(path: str) -> Dict[str, Dict[str, Any]]:
+    """读取已完成的条目；中断时可能写了一半的最后一行会被忽略"""
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            done[entry["id"]] = entry
+    return done
+
+
+def write_atomic(path: str, data: bytes):
+    """写入临时文件后原子替换目标文件"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+async def synthesize_all(args: argparse.Namespace) -> BatchStats:
+    voice_service = VoiceService()
+    if not voice_service.tts_configured:
+        # 测试模式只能得到模拟音频，写入清单后续跑会把它当作已完成
+        raise SystemExit("缺少有效的QINIU_TTS_KEY，无法合成")
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    # 清理上次被强制终止时残留的临时文件
+    for name in os.listdir(args.out_dir):
+        if name.endswith(".tmp"):
+            os.remove(os.path.join(args.out_dir, name))
+
+    manifest_path = os.path.join(args.out_dir, MANIFEST_NAME)
+    done = load_manifest(manifest_path)
+
+    stats = BatchStats()
+    totals = {"bytes": 0, "chars": 0}
+
+    def pending() -> Iterator[Dict[str, Any]]:
+        for item in read_items(args.input, args.format):
+            item["voice"] = item["voice"] or args.voice
+            item["digest"] = item_digest(item["text"], item["voice"])
+            entry = done.get(item["id"])
+            # 文件名规则变化前写入的条目（可能与其他id共用一个文件）不算完成
+            if (entry and entry.get("digest") == item["digest"] and entry.get("file") == output_name(item["id"])
+                    and os.path.exists(os.path.join(args.out_dir, entry["file"]))):
+                stats.skipped += 1
+                continue
+            yield item
+
+    async def synthesize(item: Dict[str, Any]) -> Dict[str, Any]:
+        audio = await voice_service.text_to_speech(item["text"], item["voice"], fallback=False)
+        name = output_name(item["id"])
+        write_atomic(os.path.join(args.out_dir, name), audio)
+        return {"file": name, "bytes": len(audio)}
+
+    with open(manifest_path, "a", encoding="utf-8") as manifest:
+        def on_result(item: Dict[str, Any], result: Optional[Dict[str, Any]], error: Optional[BaseException]):
+            if error is not None:
+                print(f"合成失败 {item['id']}: {error}")
+                return
+            # 输出文件落盘后才写入清单，清单中的条目一定有完整的音频
+            manifest.write(json.dumps({
+                "id": item["id"], "voice": item["voice"], "digest": item["digest"], **result
+            }, ensure_ascii=False) + "\n")
+            manifest.flush()
+            totals["bytes"] += result["bytes"]
+            totals["chars"] += len(item["text"])
+            if args.progress and stats.ok % args.progress == 0:
+                print(f"已完成 {stats.ok} 条（失败 {stats.failed}，跳过 {stats.skipped}）")
+
+        try:
+            await run_batch(pending(), synthesize, concurrency=args.concurrency, rate=args.rate,
+                            retries=args.retries, on_result=on_result, stats=stats)
+        finally:
+            await close_http_client()
+
+    summary = stats.summary()
+    print("\n合成统计：")
+    print(f"  成功 {summary['ok']} 条，失败 {summary['failed']} 条，跳过（已完成）{summary['skipped']} 条，重试 {summary['retries']} 次")
+    print(f"  耗时 {summary['elapsed']} 秒，吞吐 {summary['throughput']} 条/秒，"
+          f"{round(totals['chars'] / summary['elapsed'], 1) if summary['elapsed'] else 0} 字/秒，"
+          f"音频 {totals['bytes'] / 1024 / 1024:.2f} MB")
+    print(f"  单条耗时 p50 {summary['latency_p50']}s / p95 {summary['latency_p95']}s / 最大 {summary['latency_max']}s")
+    if voice_service.tts_cache:
+        cache = voice_service.tts_cache.stats()
+        print(f"  TTS缓存命中 {cache['hits']} 次，命中率 {cache['hit_rate']}")
+    return stats
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Batch text-to-speech with Qiniu TTS")
+    parser.add_argument("input", help="JSONL or CSV file of (id, text, voice) items")
+    parser.add_argument("--out-dir", default="tts_out", help="Output directory for audio files and manifest.jsonl")
+    parser.add_argument("--format", default="auto", choices=["auto", "jsonl", "csv"], help="Input format (default: by extension)")
+    parser.add_argument("--voice", default=None, help="Default voice_type for items without one")
+    parser.add_argument("--concurrency", type=int, default=int(os.getenv("TTS_BATCH_CONCURRENCY", "4")), help="Maximum concurrent syntheses")
+    parser.add_argument("--rate", type=float, default=float(os.getenv("TTS_BATCH_RATE", "0")), help="Maximum requests per second; 0 disables the limit")
+    parser.add_argument("--retries", type=int, default=2, help="Retries per item with exponential backoff")
+    parser.add_argument("--progress", type=int, default=100, help="Print progress every N items; 0 disables")
+    return parser
+
+
+def main() -> None:
+    args = build_parser().parse_args()
+    stats = asyncio.run(synthesize_all(args))
+    sys.exit(1 if stats.failed else 0)
+
 
 if __name__ == "__main__":
-    # 测试模式：如果没有API密钥，使用模拟数据
-    if not API_KEY:
-        print("测试模式：TTS配置缺失，使用模拟音频生成")
-        # 创建模拟音频文件
-        with open("tts_out.mp3", "wb") as f:
-            f.write(b'\xff\xfb\x90\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00')
-        print("已保存音频：tts_out.mp3，时长(毫秒)：1000")
-        exit(0)
-    
-    voice = pick_voice()
-    if not voice:
-        print("测试模式：没有获取到可用音色，使用默认音色")
-        voice = "zh-CN-XiaoxiaoNeural"
-    print("使用音色：", voice)
-    tts("你好，世界！这是七牛云 TTS 的 Python 测试。", voice, outfile="tts_out.mp3")
+    main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+DashScope / 七牛云语音 本地替身服务，用于压测和延迟调优（不消耗真实额度）。
+
+Usage examples:
+  - python upstream_stub.py --port 9000
+  - python upstream_stub.py --latency-median 0.8 --latency-sigma 0.5 --tokens-per-second 40 \
+        --error-rate 0.02 --throttle-rate 0.05
+
+让后端指向替身服务：
+  DASHSCOPE_BASE_URL=http://127.0.0.1:9000/api/v1/services/aigc/text-generation/generation
+  QINIU_BASE_URL=http://127.0.0.1:9000/v1
+
+Endpoints（与真实服务的JSON结构一致）:
+  - POST /api/v1/services/aigc/text-generation/generation  （请求头 X-DashScope-SSE: enable 时以SSE流式返回）
+  - POST /v1/voice/tts
+  - POST /v1/voice/asr
+  - GET  /v1/voice/list
+
+所有参数也可以通过 STUB_ 前缀的环境变量设置，如 STUB_ERROR_RATE=0.1。
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+app = FastAPI(title="Upstream Stub")
+
+VOICES = [
+    {"voice_name": "甜美教学小源", "voice_type": "qiniu_zh_female_tmjxxy", "category": "传统音色"},
+    {"voice_name": "校园清新学姐", "voice_type": "qiniu_zh_female_xyqxxj", "category": "传统音色"},
+    {"voice_name": "英式少年", "voice_type": "qiniu_en_male_ysyyn", "category": "英文音色"},
+]
+
+# 用于拼接模拟回复的文本片段，每个片段视为一个token
+REPLY_TOKENS = list("这是一段来自本地替身服务的模拟回复，用于测量吞吐和尾延迟。")
+
+
+async def simulate_latency():
+    """按对数正态分布模拟首字节延迟"""
+    if config.latency_median > 0:
+        await asyncio.sleep(random.lognormvariate(0, config.latency_sigma) * config.latency_median)
+
+
+def injected_error():
+    """按配置的概率注入429或5xx错误"""
+    roll = random.random()
+    if roll < config.throttle_rate:
+        return JSONResponse(
+            status_code=429,
+            content={"code": "Throttling.RateQuota", "message": "Requests rate limit exceeded, please try again later."}
+        )
+    if roll < config.throttle_rate + config.error_rate:
+        return JSONResponse(
+            status_code=500,
+            content={"code": "InternalError", "message": "An internal error has occured, please try again later."}
+        )
+    return None
+
+
+def reply_tokens():
+    """生成一次回复的token序列"""
+    return [REPLY_TOKENS[i % len(REPLY_TOKENS)] for i in range(config.reply_tokens)]
+
+
+def usage_block(body: dict, output_tokens: int) -> dict:
+    messages = body.get("input", {}).get("messages", [])
+    input_tokens = sum(len(message.get("content", "")) for message in messages)
+    return {
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "total_tokens": input_tokens + output_tokens
+    }
+
+
+@app.post("/api/v1/services/aigc/text-generation/generation")
+async def text_generation(request: Request):
+    """通义千问文本生成"""
+    body = await request.json()
+    await simulate_latency()
+    error = injected_error()
+    if error:
+        return error
+
+    request_id = str(uuid.uuid4())
+    tokens = reply_tokens()
+
+    if request.headers.get("X-DashScope-SSE", "").lower() != "enable":
+        # 非流式：按token速率等待整段回复生成完
+        if config.tokens_per_second > 0:
+            await asyncio.sleep(len(tokens) / config.tokens_per_second)
+        return {
+            "output": {"text": "".join(tokens), "finish_reason": "stop"},
+            "usage": usage_block(body, len(tokens)),
+            "request_id": request_id
+        }
+
+    incremental = body.get("parameters", {}).get("incremental_output", False)
+
+    async def events():
+        for index, _ in enumerate(tokens):
+            if config.tokens_per_second > 0:
+                await asyncio.sleep(1 / config.tokens_per_second)
+            finished = index == len(tokens) - 1
+            text = tokens[index] if incremental else "".join(tokens[:index + 1])
+            data = {
+                "output": {"text": text, "finish_reason": "stop" if finished else "null"},
+                "usage": usage_block(body, index + 1),
+                "request_id": request_id
+            }
+            yield f"id:{index + 1}\nevent:result\n:HTTP_STATUS/200\ndata:{json.dumps(data, ensure_ascii=False)}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.post("/v1/voice/tts")
+async def voice_tts(request: Request):
+    """七牛云语音合成"""
+    body = await request.json()
+    await simulate_latency()
+    error = injected_error()
+    if error:
+        return error
+
+    text = body.get("request", {}).get("text", "")
+    # 合成耗时与文本长度成正比
+    if config.tokens_per_second > 0:
+        await asyncio.sleep(len(text) / (config.tokens_per_second * 4))
+    audio = os.urandom(config.audio_bytes)
+    return {
+        "reqid": str(uuid.uuid4()),
+        "operation": "query",
+        "sequence": -1,
+        "data": base64.b64encode(audio).decode("utf-8"),
+        "addition": {"duration": str(max(1, len(text)) * 250)}
+    }
+
+
+@app.post("/v1/voice/asr")
+async def voice_asr(request: Request):
+    """七牛云语音识别"""
+    await request.json()
+    await simulate_latency()
+    error = injected_error()
+    if error:
+        return error
+
+    return {
+        "reqid": str(uuid.uuid4()),
+        "operation": "asr",
+        "data": {
+            "audio_info": {"duration": 2000},
+            "result": {"additions": {"duration": "2000"}, "text": config.asr_text}
+        }
+    }
+
+
+@app.get("/v1/voice/list")
+async def voice_list():
+    """七牛云音色列表"""
+    await simulate_latency()
+    return [
+        {**voice, "url": f"https://example.invalid/{voice['voice_type']}.mp3", "updatetime": 1700000000000}
+        for voice in VOICES
+    ]
+
+
+def env_default(name: str, default):
+    return type(default)(os.getenv(f"STUB_{name.upper()}", default))
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="DashScope / Qiniu voice local stub server")
+    parser.add_argument("--host", default=env_default("host", "127.0.0.1"), help="Bind address")
+    parser.add_argument("--port", type=int, default=env_default("port", 9000), help="Port")
+    parser.add_argument("--latency-median", type=float, default=env_default("latency_median", 0.3), help="Median time to first byte in seconds (lognormal)")
+    parser.add_argument("--latency-sigma", type=float, default=env_default("latency_sigma", 0.5), help="Lognormal sigma of time to first byte")
+    parser.add_argument("--tokens-per-second", type=float, default=env_default("tokens_per_second", 30.0), help="Generation speed; 0 disables the delay")
+    parser.add_argument("--reply-tokens", type=int, default=env_default("reply_tokens", 120), help="Tokens per generated reply")
+    parser.add_argument("--error-rate", type=float, default=env_default("error_rate", 0.0), help="Probability of an injected 500")
+    parser.add_argument("--throttle-rate", type=float, default=env_default("throttle_rate", 0.0), help="Probability of an injected 429")
+    parser.add_argument("--audio-bytes", type=int, default=env_default("audio_bytes", 32000), help="Size of synthesized audio payloads")
+    parser.add_argument("--asr-text", default=env_default("asr_text", "你好"), help="Text returned by ASR")
+    return parser
+
+
+# 运行配置：默认值来自环境变量，main()中再用命令行参数覆盖
+config = build_parser().parse_args([])
+
+
+def main() -> None:
+    args = build_parser().parse_args()
+    vars(config).update(vars(args))
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()